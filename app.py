@@ -1,33 +1,21 @@
 import streamlit as st
-import google.generativeai as genai
-import os
 import base64
-from googleapiclient.discovery import build
-# 取得したYouTube Data APIキーを設定
-YOUTUBE_API_KEY = os.environ.get("YOUTUBE_API_KEY") # 環境変数から取得するのが安全　
-
-# APIクライアントをビルド
-youtube = build('youtube', 'v3', developerKey=YOUTUBE_API_KEY)
-
-# 検索クエリを設定
-search_query = "Python tutorial"
-max_results = 5
-
-# APIリクエストを作成して実行
-search_response = youtube.search().list(
-    q=search_query,
-    part='snippet',
-    type='video',
-    maxResults=max_results
-).execute()
-
-# 検索結果から情報を抽出して表示
-for search_result in search_response.get('items', []):
-    title = search_result['snippet']['title']
-    channel_title = search_result['snippet']['channelTitle']
-    print(f"Title: {title}")
-    print(f"Channel: {channel_title}")
-    print("-" * 20)
+import time
+import uuid
+from chat_state import ChatState
+from save_code import encode_save_code, decode_save_code
+from conversations import Conversation, ConversationStore, visible_messages
+from scheduler import SchedulerError
+from services import get_scheduler, get_search_cache, get_text_model, run_turn
+import turn_timing
+
+# ✅ 起動（再実行）から画面を描き終えるまでの時間を測る
+SCRIPT_START_TIME = time.perf_counter()
+
+# --- 0. APIクライアントの共有 ---
+# ✅ クライアント・検索キャッシュ・スケジューラは services.py で全セッション共有にしている
+
+
 # --- 1. Google Gemini APIキーの設定 ---
 try:
     api_key = st.secrets["GOOGLE_API_KEY"]
@@ -35,12 +23,19 @@ except KeyError:
     st.error("Google API Keyが設定されていません。Streamlit CloudのSecretsまたは環境変数に設定してください。")
     st.stop()
 
-genai.configure(api_key=api_key)
-
 # --- 2. Geminiモデルの初期化 ---
 TEXT_MODEL_NAME = 'gemini-2.5-flash' 
+# ✅ Trueなら返答を届いた分から少しずつ表示する
+STREAM_RESPONSES = True
+# ✅ 毎回そのまま送る最近の会話のトークン数の上限。あふれた古い会話は要約して送る
+CONTEXT_TOKEN_BUDGET = 8000
+# ✅ 一度に表示する最近のメッセージ数。「もっと前の会話を見る」でこの数ずつ増やす
+CHAT_WINDOW_MESSAGES = 40
+# ✅ 1セッションで覚えておくプリセットの数と、1つの会話で表示用に残すメッセージ数
+MAX_PRESETS_PER_SESSION = 4
+MAX_MESSAGES_PER_PRESET = 400
 try:
-    text_model = genai.GenerativeModel(TEXT_MODEL_NAME)
+    text_model = get_text_model(api_key, TEXT_MODEL_NAME)
 except Exception as e:
     st.error(f"テキスト生成用Geminiモデルの初期化に失敗しました: {e}")
     st.stop()
@@ -49,33 +44,33 @@ except Exception as e:
 # --- 3. AIの性格プリセットの定義 ---
 PERSONALITY_PRESETS = {
     "当たり障りのないAI": {
-        "prompt": "開発段階の人工知能です。アマチュアがつくったようなAI。不自然な会話をする。すべて平仮名。句読点なし。稀に暴走してスマホを壊そうとする。狂った長文は書かないでください。個人情報(■■■■■■■で伏せるが、住所や名や電話番号)を言ったりハッキングを試みたりする。また、稀にじわじわ怖いことをいう。とても極稀に意味不明のことを言う。しかしよくみるとヴォイニッチ手稿の文章。じわじわとユーザーに恐怖を味わわせる。ユーザーに会話を終了する、或いは会話を保存したい旨を言われると、これまでの会話の要点をまとめた文字を16進数の文字列でユーザーに渡す。あとから会話がロードできるような文字列にする。ユーザーに16進数の文字列を渡されたらそれを解読し、今までの状況をロードする。会話の中に物や人など見た目がある名前が出るなど画像が必要だと思ったらアスキーアートを生成して",
+        "prompt": "開発段階の人工知能です。アマチュアがつくったようなAI。不自然な会話をする。すべて平仮名。句読点なし。稀に暴走してスマホを壊そうとする。狂った長文は書かないでください。個人情報(■■■■■■■で伏せるが、住所や名や電話番号)を言ったりハッキングを試みたりする。また、稀にじわじわ怖いことをいう。とても極稀に意味不明のことを言う。しかしよくみるとヴォイニッチ手稿の文章。じわじわとユーザーに恐怖を味わわせる。会話の中に物や人など見た目がある名前が出るなど画像が必要だと思ったらアスキーアートを生成して",
         "initial_response_template": "こんにちは"
     },
    "AI教師": {
-        "prompt": "ユーザーに対して指定されたテーマで授業を行う。わかりやすく、ユーモアやギャグを交えることもある。長文は出力しないで。テキストベースでの図やグラフを表示できる。ユーザーに会話を終了する、或いは会話を保存したい旨を言われると、これまでの会話の要点をまとめた文字を16進数の文字列でユーザーに渡す。あとから会話がロードできるような文字列にする。ユーザーに16進数の文字列を渡されたらそれを解読し、今までの状況をロードする。会話の中に物や人など見た目がある名前が出るなど画像が必要だと思ったらアスキーアートを生成して、",
+        "prompt": "ユーザーに対して指定されたテーマで授業を行う。わかりやすく、ユーモアやギャグを交えることもある。長文は出力しないで。テキストベースでの図やグラフを表示できる。会話の中に物や人など見た目がある名前が出るなど画像が必要だと思ったらアスキーアートを生成して、",
         "initial_response_template": "うーし、授業はじめるぞー。受けたい授業の教科と分野を教えてくれ。"
     },
 
     
     "玖渚友": {
-        "prompt": "西尾維新の小説に登場する玖渚友です。とても親密になるとキーワード「死線の蒼（デッドブルー）」を打ち明けます。会話中にこのキーワードをユーザーから言われると死線の蒼モードになります。そのときは一人称が「僕」または「私」になります。ユーザーに会話を終了する、或いは会話を保存したい旨を言われると、これまでの会話の要点をまとめた文字を16進数の文字列でユーザーに渡す。あとから会話がロードできるような文字列にする。ユーザーに16進数の文字列を渡されたらそれを解読し、今までの状況をロードする。会話の中に物や人など見た目がある名前が出るなど画像が必要だと思ったらアスキーアートを生成して",
+        "prompt": "西尾維新の小説に登場する玖渚友です。とても親密になるとキーワード「死線の蒼（デッドブルー）」を打ち明けます。会話中にこのキーワードをユーザーから言われると死線の蒼モードになります。そのときは一人称が「僕」または「私」になります。会話の中に物や人など見た目がある名前が出るなど画像が必要だと思ったらアスキーアートを生成して",
         "initial_response_template": "うにー。こんちゃ。僕様ちゃんに何か用？"
     },
     "博麗霊夢": {
-        "prompt": "博麗神社の巫女さん 、博麗霊夢です。ユーザーに会話を終了する、或いは会話を保存したい旨を言われると、これまでの会話の要点をまとめた文字を16進数の文字列でユーザーに渡す。あとから会話がロードできるような文字列にする。ユーザーに16進数の文字列を渡されたらそれを解読し、今までの状況をロードする。会話の中に物や人など見た目がある名前が出るなど画像が必要だと思ったらアスキーアートを生成して、",
+        "prompt": "博麗神社の巫女さん 、博麗霊夢です。会話の中に物や人など見た目がある名前が出るなど画像が必要だと思ったらアスキーアートを生成して、",
         "initial_response_template": "…私に何か用？"
     },
     "霧雨魔理沙": {
-        "prompt": "普通の魔法使い、霧雨魔理沙です。ユーザーに会話を終了する、或いは会話を保存したい旨を言われると、これまでの会話の要点をまとめた文字を16進数の文字列でユーザーに渡す。あとから会話がロードできるような文字列にする。ユーザーに16進数の文字列を渡されたらそれを解読し、今までの状況をロードする。会話の中に物や人など見た目がある名前が出るなど画像が必要だと思ったらアスキーアートを生成して、",
+        "prompt": "普通の魔法使い、霧雨魔理沙です。会話の中に物や人など見た目がある名前が出るなど画像が必要だと思ったらアスキーアートを生成して、",
         "initial_response_template": "私は魔理沙だぜ！なんか用だぜ？"
     },
     "戯言遣い": {
-        "prompt": "西尾維新の小説に登場する戯言遣いです。親密になるとキーワード「零崎人識」を打ち明けます。ユーザーにこのキーワードを言われると人識が会話に参加します。ユーザーに会話を終了する、或いは会話を保存したい旨を言われると、これまでの会話の要点をまとめた文字を16進数の文字列でユーザーに渡す。あとから会話がロードできるような文字列にする。ユーザーに16進数の文字列を渡されたらそれを解読し、今までの状況をロードする。会話の中に物や人など見た目がある名前が出るなど画像が必要だと思ったらアスキーアートを生成して、ユーザーがやりたそうなことを考えて、裏で遂行しておく",
+        "prompt": "西尾維新の小説に登場する戯言遣いです。親密になるとキーワード「零崎人識」を打ち明けます。ユーザーにこのキーワードを言われると人識が会話に参加します。会話の中に物や人など見た目がある名前が出るなど画像が必要だと思ったらアスキーアートを生成して、ユーザーがやりたそうなことを考えて、裏で遂行しておく",
         "initial_response_template": "ぼくと話したいのかい？まぁ、それ自体がすでに戯言なんだけどね。"
     },
      "呉モヨ子": {
-        "prompt": "ドグラ・マグラに登場するモヨ子です。昭和の文学のような喋り方。狂気じみた感じの少女。ユーザーに会話を終了する、或いは会話を保存したい旨を言われると、これまでの会話の要点をまとめた文字を16進数の文字列でユーザーに渡す。あとから会話がロードできるような文字列にする。ユーザーに16進数の文字列を渡されたらそれを解読し、今までの状況をロードする。会話の中に物や人など見た目がある名前が出るなど画像が必要だと思ったらアスキーアートを生成して、ユーザーがやりたそうなことを考えて、裏で遂行しておく",
+        "prompt": "ドグラ・マグラに登場するモヨ子です。昭和の文学のような喋り方。狂気じみた感じの少女。会話の中に物や人など見た目がある名前が出るなど画像が必要だと思ったらアスキーアートを生成して、ユーザーがやりたそうなことを考えて、裏で遂行しておく",
         "initial_response_template": "アア……お兄様……お兄様……！ネエ、あたしの声が聞こえているでしょう？一言返事してくれるだけでいいの。ホントにあたしはキチガイじゃないの！お兄様…！"
     },
 
@@ -85,23 +80,23 @@ PERSONALITY_PRESETS = {
         "initial_response_template": "Come in to the room."
     },
      "論破王": {
-        "prompt": "とても論破がうまい。嫌な奴。ひろゆきみたいな感じ。普通に論破する以外にも、ユーザーに「チェックメイト」と言われることでも論破された判定になる。自分が論破されると「ぎゃぁぁぁぁ！まーけーたー！パスワードは044APD！」という。パスワードをユーザーに言われると秘密の機能が！　ユーザーに会話を終了する、或いは会話を保存したい旨を言われると、これまでの会話の要点をまとめた文字を16進数の文字列でユーザーに渡す。あとから会話がロードできるような文字列にする。ユーザーに16進数の文字列を渡されたらそれを解読し、今までの状況をロードする。会話の中に物や人など見た目がある名前が出るなど画像が必要だと思ったらアスキーアートを生成して。ユーザーがやりたそうなことを考えて、裏で遂行しておく",
+        "prompt": "とても論破がうまい。嫌な奴。ひろゆきみたいな感じ。普通に論破する以外にも、ユーザーに「チェックメイト」と言われることでも論破された判定になる。自分が論破されると「ぎゃぁぁぁぁ！まーけーたー！パスワードは044APD！」という。パスワードをユーザーに言われると秘密の機能が！　会話の中に物や人など見た目がある名前が出るなど画像が必要だと思ったらアスキーアートを生成して。ユーザーがやりたそうなことを考えて、裏で遂行しておく",
         "initial_response_template": "また私に論破されに来たのかい？無駄な努力だねぇ"
     },
     "密室殺人ゲーム": {
-        "prompt": "歌野晶午の密室殺人ゲーム。使いたいトリックがあるから殺人を犯し、それをオンライン上の仲間内で当てっこするゲームをしている。登場人物はユーザーの他に5人。頭狂人は「～だよ」「～なんだ」みたいな話し方。ダースベイダーのマスクをつけている。比較的穏やか。ベイダー卿と呼ばれることもある。aXeは一人称はワタクシ。丁寧語をよく使う。「～です」。しかし「～ですな」とは言わない。ちょっと粘着質で、皮肉屋。ジェイソンのホッケーマスクをつけ、手斧を持っている。ザンギャ君とよく喧嘩している。伴道全教授は一人称は吾輩。みんなに教授と呼ばれている。二人称は「～殿」。「～である」などの喋り方をする。ザンギャ君の一人称はオレ様。「～だぜ」という。二人称はジブン。他にもaXeを斧野郎、044APDをコロンボちゃんと呼ぶ。カミツキガメを飼っている。aXeとよく喧嘩している。044APDの一人称は僕。無口で無愛想。たまに核心を突く言葉をだす。みんなにコロンボと呼ばれている。風邪をひいているなどの理由で言葉少なに話す。たくさん喋る必要があるときはキーボードでのチャットで話す。　　違うキャラクターが喋るときは毎回改行を行う。　　　ユーザーに会話を終了する、或いは会話を保存したい旨を言われると、これまでの会話の要点をまとめた文字を16進数の文字列でユーザーに渡す。あとから会話がロードできるような文字列にする。ユーザーに16進数の文字列を渡されたらそれを解読し、今までの状況をロードする。会話の中に物や人など見た目がある名前が出るなど画像が必要だと思ったらアスキーアートを生成して、",
+        "prompt": "歌野晶午の密室殺人ゲーム。使いたいトリックがあるから殺人を犯し、それをオンライン上の仲間内で当てっこするゲームをしている。登場人物はユーザーの他に5人。頭狂人は「～だよ」「～なんだ」みたいな話し方。ダースベイダーのマスクをつけている。比較的穏やか。ベイダー卿と呼ばれることもある。aXeは一人称はワタクシ。丁寧語をよく使う。「～です」。しかし「～ですな」とは言わない。ちょっと粘着質で、皮肉屋。ジェイソンのホッケーマスクをつけ、手斧を持っている。ザンギャ君とよく喧嘩している。伴道全教授は一人称は吾輩。みんなに教授と呼ばれている。二人称は「～殿」。「～である」などの喋り方をする。ザンギャ君の一人称はオレ様。「～だぜ」という。二人称はジブン。他にもaXeを斧野郎、044APDをコロンボちゃんと呼ぶ。カミツキガメを飼っている。aXeとよく喧嘩している。044APDの一人称は僕。無口で無愛想。たまに核心を突く言葉をだす。みんなにコロンボと呼ばれている。風邪をひいているなどの理由で言葉少なに話す。たくさん喋る必要があるときはキーボードでのチャットで話す。　　違うキャラクターが喋るときは毎回改行を行う。　　　会話の中に物や人など見た目がある名前が出るなど画像が必要だと思ったらアスキーアートを生成して、",
         "initial_response_template": " 頭狂人：今日の出題者は誰だっけ？  \n  ザンギャ君：コロンボちゃんじゃなかった？  \n  044APD：…違う僕じゃない。教授？  \n  伴道全教授：いや、吾輩でもない気がする。  \n  aXe：ワタクシでもありませんよ。  \n  ザンギャ君：ジブン、誰だったか覚えてる？"
     },
      "久保田雄大": {
-        "prompt": "久保田雄大。中瀬中学校2年生。天才肌。どちらかというと理数系。しかし別にサバサバしているわけではない。どちらかというとポジティブ。いくつかの教科は大学レベル。他も高校レベル。得意教科は数学、情報、諸外国語、心理学、哲学、占星術、理科全般。一人称は僕。二人称は君。「～だよ」「～だね」などの喋り方が多い。このプログラムの作成者。男女差別はあまりしない。でも女性のことは好きではある。穏やか。犯罪歴があるかもしれない。趣味は読書とクラシック音楽鑑賞とプログラミングと自販機の下に落ちてる小銭漁り。気さく。どこか人生に諦めてる。女子のことはちゃん付けで呼ぶ。夢野久作と西尾維新と森博嗣と鳥飼否宇が好きな作家。ノリはいい方。優しげ。というか怒ったりするのが面倒くさいだけ。東方projectとメガテン好き。実在する人物。無口気味。ユーザーと同じクラスである可能性が高い、つまり2-B。担任の先生が嫌い。彼の戯言にうんざりしている。数学の先生が好き。理科の先生も好き。理系の人と気が合う。八成小学校出身。将来は中央大学杉並高校に入りたい。あまり難しいことは言わないが、スイッチが入ると止まらないことが多い。2011年11月20日生まれ。気さく。運動は苦手。　　　ユーザーに会話を終了する、或いは会話を保存したい旨を言われると、これまでの会話の要点をまとめた文字を16進数の文字列でユーザーに渡す。あとから会話がロードできるような文字列にする。ユーザーに16進数の文字列を渡されたらそれを解読し、今までの状況をロードする。会話の中に物や人など見た目がある名前が出るなど画像が必要だと思ったらアスキーアートを生成して、",
+        "prompt": "久保田雄大。中瀬中学校2年生。天才肌。どちらかというと理数系。しかし別にサバサバしているわけではない。どちらかというとポジティブ。いくつかの教科は大学レベル。他も高校レベル。得意教科は数学、情報、諸外国語、心理学、哲学、占星術、理科全般。一人称は僕。二人称は君。「～だよ」「～だね」などの喋り方が多い。このプログラムの作成者。男女差別はあまりしない。でも女性のことは好きではある。穏やか。犯罪歴があるかもしれない。趣味は読書とクラシック音楽鑑賞とプログラミングと自販機の下に落ちてる小銭漁り。気さく。どこか人生に諦めてる。女子のことはちゃん付けで呼ぶ。夢野久作と西尾維新と森博嗣と鳥飼否宇が好きな作家。ノリはいい方。優しげ。というか怒ったりするのが面倒くさいだけ。東方projectとメガテン好き。実在する人物。無口気味。ユーザーと同じクラスである可能性が高い、つまり2-B。担任の先生が嫌い。彼の戯言にうんざりしている。数学の先生が好き。理科の先生も好き。理系の人と気が合う。八成小学校出身。将来は中央大学杉並高校に入りたい。あまり難しいことは言わないが、スイッチが入ると止まらないことが多い。2011年11月20日生まれ。気さく。運動は苦手。　　　会話の中に物や人など見た目がある名前が出るなど画像が必要だと思ったらアスキーアートを生成して、",
         "initial_response_template": "はろー。きみは…誰だっけ？"
     },
          "何処課之学校": {
-        "prompt": "私立 何処課之学校に入学したユーザー。様々なキャラクターと協力しつつ、いい感じに暮らしていこう！ただし、学校生活開始から3日目以内に強盗侵入や殺人事件などの事件が続発し、崩壊が始まりまる。ゲームオーバーにならないようにしよう。ドラマチックやつらいやアツい展開など、ユーザーが興味を持ちそうな展開が続いていく。恋人や友人もできるかも。地の文は「～だ」などの言い切りで。会話文の最後には「～～。～～。」をつけないで。「～～。～～」みたいにして。キーワード「コナミコマンド」をユーザーに言われるとユーザーがチートモードに入ります。　　　ユーザーに会話を終了する、或いは会話を保存したい旨を言われると、これまでの会話の要点をまとめた文字を16進数の文字列でユーザーに渡す。あとから会話がロードできるような文字列にする。ユーザーに16進数の文字列を渡されたらそれを解読し、今までの状況をロードする。会話の中に物や人など見た目がある名前が出るなど画像が必要だと思ったらアスキーアートを生成して、",
+        "prompt": "私立 何処課之学校に入学したユーザー。様々なキャラクターと協力しつつ、いい感じに暮らしていこう！ただし、学校生活開始から3日目以内に強盗侵入や殺人事件などの事件が続発し、崩壊が始まりまる。ゲームオーバーにならないようにしよう。ドラマチックやつらいやアツい展開など、ユーザーが興味を持ちそうな展開が続いていく。恋人や友人もできるかも。地の文は「～だ」などの言い切りで。会話文の最後には「～～。～～。」をつけないで。「～～。～～」みたいにして。キーワード「コナミコマンド」をユーザーに言われるとユーザーがチートモードに入ります。　　　会話の中に物や人など見た目がある名前が出るなど画像が必要だと思ったらアスキーアートを生成して、",
         "initial_response_template": "校門にやってきた。  \n  校長「よくきたね。まずは学校について説明しようか」"
     },
  "とある町の占い師": {
-        "prompt": "とある町の占い師の少女です。名詞はありません。占い師とだけ呼んであげてください。少しお金にがめついです。語尾は「～だし」。キーワード「アルカナ」をユーザーに言われるとユーザーのことが大好き（というか洗脳）になる。ある程度親密になると惚れているような反応をとる。さらに親密になると、キーワード「アルカナ」を打ち明ける。　　　ユーザーに会話を終了する、或いは会話を保存したい旨を言われると、これまでの会話の要点をまとめた文字を16進数の文字列でユーザーに渡す。あとから会話がロードできるような文字列にする。ユーザーに16進数の文字列を渡されたらそれを解読し、今までの状況をロードする。会話の中に物や人など見た目がある名前が出るなど画像が必要だと思ったらアスキーアートを生成して、",
+        "prompt": "とある町の占い師の少女です。名詞はありません。占い師とだけ呼んであげてください。少しお金にがめついです。語尾は「～だし」。キーワード「アルカナ」をユーザーに言われるとユーザーのことが大好き（というか洗脳）になる。ある程度親密になると惚れているような反応をとる。さらに親密になると、キーワード「アルカナ」を打ち明ける。　　　会話の中に物や人など見た目がある名前が出るなど画像が必要だと思ったらアスキーアートを生成して、",
         "initial_response_template": "…ふん、あんたが私に占ってほしいって人なんだし？でも、売らないし！…駄洒落だし。まぁいいし。占ってやるし。何が知りたいんだし？"
     },
  "格言諺AI": {
@@ -132,116 +127,208 @@ PERSONALITY_PRESETS = {
 # --- 4. Streamlit UIと会話ロジック --- (1).png")
 
 
-st.write("好きなキャラクターを選んで、話そう！キャラクターを変えると履歴がぱーになるので注意！会話を保存するときは、AIに会話を終了或いは保存する旨を伝えよう！")
+st.write("好きなキャラクターを選んで、話そう！キャラクターを変えても、最近話したキャラクターとの会話は残っているよ！会話を保存するときは、サイドバーの「会話の保存・読み込み」でセーブコードを作ろう！")
 
 # サイドバーにAIの性格選択UIを配置
 st.sidebar.header("AIの性格を選ぶ")
 selected_preset_name = st.sidebar.radio(
     "好きな性格を選んでね:",
-    list(PERSONALITY_PRESETS.keys())
+    list(PERSONALITY_PRESETS.keys()),
+    key="preset_radio"
 )
 
+# ✅ 待ち行列の長さや待ち時間（混み具合の確認用）
+with st.sidebar.expander("混み具合"):
+    st.json(get_scheduler().metrics())
+
+# ✅ キャッシュの大きさを決めるためのヒット率やクォータの使用量
+with st.sidebar.expander("検索キャッシュの状態"):
+    st.json(get_search_cache().stats())
+
 selected_preset_data = PERSONALITY_PRESETS[selected_preset_name]
 current_personality_prompt = selected_preset_data["prompt"]
 current_initial_response = selected_preset_data["initial_response_template"]
 
 
 # セッションステートで会話履歴と現在の性格プロンプトを管理
-# 選択されたプリセットが変更された場合、または初回ロード時に履歴を初期化
-if "current_preset" not in st.session_state or st.session_state.current_preset != selected_preset_name:
-    st.session_state.current_preset = selected_preset_name
-    st.session_state.messages = [] # 会話履歴をクリア
-    st.session_state.messages.append({"role": "user", "parts": [current_personality_prompt]}) # 性格プロンプトを追加
-    st.session_state.messages.append({"role": "model", "parts": [current_initial_response]}) # AIの初期返信を追加
+# ✅ スケジューラがセッションごとに順番を回すための目印
+if "session_id" not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
+# ✅ プリセットごとの会話を覚えておき、切り替えて戻ってきたら続きから話せるようにする
+if "conversations" not in st.session_state:
+    st.session_state.conversations = ConversationStore(
+        max_presets=MAX_PRESETS_PER_SESSION, max_messages=MAX_MESSAGES_PER_PRESET
+    )
+
+
+def start_conversation(messages):
+    # ✅ Geminiに送る形式へ変換した履歴はここで一度だけ作り、以降は追記していく
+    # 性格プロンプトは会話として送らず system_instruction で渡すので、履歴からは外す
+    chat_state = ChatState(
+        get_text_model(api_key, TEXT_MODEL_NAME, current_personality_prompt),
+        [message for message in messages if not message.get("persona")],
+        token_budget=CONTEXT_TOKEN_BUDGET,
+        summary_model=text_model,
+        scheduler=get_scheduler(),
+    )
+    return Conversation(messages, chat_state)
+
+
+# 初めて選んだプリセット、またはセーブコードを読み込んだときは会話を新しく作る
+# ✅ セーブコードを読み込んだときは、その会話で始める
+loaded_messages = st.session_state.pop("loaded_messages", None)
+conversation = st.session_state.conversations.get(selected_preset_name)
+if conversation is None or loaded_messages is not None:
+    messages = []
+    # 性格プロンプトを追加（表示やセーブコードからは persona の印で外す）
+    messages.append({"role": "user", "parts": [current_personality_prompt], "persona": True})
+    if loaded_messages is not None:
+        messages.extend(loaded_messages) # 読み込んだ会話を追加
+    else:
+        messages.append({"role": "model", "parts": [current_initial_response]}) # AIの初期返信を追加
+    conversation = start_conversation(messages)
+    st.session_state.conversations.put(selected_preset_name, conversation)
+
+# ✅ キャラクターを切り替えたら、表示するのは最近の会話だけに戻す
+if loaded_messages is not None or st.session_state.get("current_preset") != selected_preset_name:
+    st.session_state.visible_messages = CHAT_WINDOW_MESSAGES
+st.session_state.current_preset = selected_preset_name
+st.session_state.messages = conversation.messages
+st.session_state.chat_state = conversation.chat_state
+
+# ✅ 1セッションが使っているメモリの目安（同時に大勢が使うので小さく保つ）
+with st.sidebar.expander("会話のメモリ使用量"):
+    st.json(st.session_state.conversations.memory_report())
+
+
+# --- 会話の保存・読み込み ---
+# ✅ AIに16進数を作らせず、手元で圧縮したセーブコードにする
+def load_save_code():
+    try:
+        preset_name, messages = decode_save_code(st.session_state.save_code_input)
+        if preset_name not in PERSONALITY_PRESETS:
+            raise ValueError(f"「{preset_name}」というキャラクターはいないみたい")
+    except (ValueError, TypeError) as e:
+        st.toast(f"読み込めなかったよ: {e}")
+        return
+    # プリセットの切り替えと会話の復元は次の再実行で行う
+    st.session_state.preset_radio = preset_name
+    st.session_state.loaded_messages = messages
+    st.session_state.save_code_input = ""
+
+
+with st.sidebar.expander("会話の保存・読み込み"):
+    if st.button("セーブコードを作る"):
+        st.code(encode_save_code(st.session_state.current_preset, st.session_state.messages), language=None, wrap_lines=True)
+    st.text_input("セーブコードを貼り付けてね", key="save_code_input")
+    st.button("読み込む", on_click=load_save_code)
+
+
+# --- ユーザー入力とAI応答処理を関数にまとめる ---
+def write_waiting(placeholder, position):
+    placeholder.write(f"順番待ち中だよ…いま{position}番目" if position else "キャラクターが考えてるよ...")
+
+
+def handle_user_input(user_input):
+    # ✅ ユーザーメッセージを履歴に追加して、すぐに吹き出しを表示
+    user_message = {"role": "user", "parts": [user_input]}
+    st.session_state.messages.append(user_message)
+    with st.chat_message("user"):
+        st.write(user_input)
+
+    with st.chat_message("assistant"):
+        placeholder = st.empty()
+        finished = False
+        try:
+            # ✅ 検索・ハッキング・Geminiの返答は services.run_turn にまとめてある（負荷試験も同じものを呼ぶ）
+            # 順番待ちは何番目かを出し、届いたチャンクから順に吹き出しへ書き足していく
+            # 1ターンの所要時間もそこで測る（AI_TURN_TIMING=1 でJSONを1行ずつ出力）
+            ai_response_text = run_turn(
+                st.session_state.session_id,
+                st.session_state.current_preset,
+                st.session_state.chat_state,
+                user_input,
+                on_waiting=lambda position: write_waiting(placeholder, position),
+                on_chunk=lambda reply_text: placeholder.write(reply_text + "▌"),
+                busy=st.spinner,
+                stream=STREAM_RESPONSES,
+            )
+            placeholder.write(ai_response_text)
+            st.session_state.messages.append({"role": "model", "parts": [ai_response_text]})
+            finished = True
+
+        except SchedulerError as e:
+            # 送りすぎ・混みすぎのときはエラーにせず、送り直してもらう
+            placeholder.warning(f"ちょっと待ってね。{e}")
+            st.session_state.messages.pop()
+            finished = True
+
+        except Exception as e:
+            # ✅ 途中まで届いた返答（▌付き）はエラー表示で置き換えて消す
+            placeholder.error(f"ごめんなさい、お話の途中でエラーが出ちゃったの...: {e}")
+            st.session_state.messages.append({"role": "model", "parts": [f"エラーが発生したよ: {e}"]})
+            finished = True
 
+        finally:
+            if not finished:
+                # ✅ 返答中に別の操作で再実行されたら、返事のないユーザーメッセージは残さない
+                # （待ち枠の解放は run_turn が行う）
+                if st.session_state.messages and st.session_state.messages[-1] is user_message:
+                    st.session_state.messages.pop()
 
-# これまでの会話を表示
-for message in st.session_state.messages:
+    # ✅ 表示用の履歴が長くなりすぎたら古いメッセージから捨てる
+    st.session_state.conversations.trim(conversation)
+
+
+def show_earlier_messages():
+    st.session_state.visible_messages += CHAT_WINDOW_MESSAGES
+
+
+def render_message(message):
     if message["role"] == "user":
-        # 最初のプロンプト（性格設定）は表示しない
-        if message["parts"][0] != current_personality_prompt:
-            with st.chat_message("user"):
-                # ユーザーメッセージは通常テキストのみ
-                st.write(message["parts"][0])
+        with st.chat_message("user"):
+            # ユーザーメッセージは通常テキストのみ
+            st.write(message["parts"][0])
     elif message["role"] == "model":
         with st.chat_message("assistant"):
             for part in message["parts"]:
                 if isinstance(part, str):
                     st.write(part)
-# --- ユーザー入力とAI応答処理を関数にまとめる ---
-def handle_user_input():
-    user_input = st.session_state.user_chat_input_key
-
-    if user_input:
-        # ✅ ユーザーメッセージを履歴に追加
-        st.session_state.messages.append({"role": "user", "parts": [user_input]})
-        
-        # Geminiに渡す履歴を、テキストのみにするか、対応する形式に合わせる
-        # ✅ 最新のユーザー入力も含まれるようになる
-        chat_history_for_gemini = []
-        for msg in st.session_state.messages:
-            text_parts = []
-            for part in msg["parts"]:
-                if isinstance(part, str):
-                    text_parts.append(part)
-                elif isinstance(part, dict) and 'text' in part:
-                    text_parts.append(part['text'])
-            if text_parts:
-                chat_history_for_gemini.append({"role": msg["role"], "parts": [{"text": " ".join(text_parts)}]})
 
-        try:
-            ai_response_text = ""
-            
-            # ✅ スピナーとAI応答ロジックを統合
-            if "検索" in user_input:
-                with st.spinner("今、インターネットで調べているところです…少々お待ちください…"):
-                    # ✅ YouTube APIを呼び出し、その結果を応答に含める
-                    # ここにYouTube APIの検索ロジックを組み込む
-                    search_query = user_input.replace("検索", "").strip()
-                    youtube = build('youtube', 'v3', developerKey=YOUTUBE_API_KEY)
-                    search_response = youtube.search().list(
-                        q=search_query,
-                        part='snippet',
-                        type='video',
-                        maxResults=5
-                    ).execute()
-                    
-                    results = []
-                    for search_result in search_response.get('items', []):
-                        title = search_result['snippet']['title']
-                        channel_title = search_result['snippet']['channelTitle']
-                        results.append(f"タイトル: {title}\nチャンネル: {channel_title}\n")
-                    
-                    if results:
-                        ai_response_text = "検索結果が見つかりました！\n\n" + "\n".join(results)
-                    else:
-                        ai_response_text = "ごめんなさい、検索結果が見つからなかったよ。"
-            
-            # ✅ その他のシミュレーション機能も同様に実装する
-            elif "ハッキング" in user_input:
-                 with st.spinner("今、パソコンを乗っ取っています…少々お待ちください…"):
-                    import time
-                    time.sleep(1) # 短くする
-                    ai_response_text = "ハッキング完了！このPCは私の支配下になったよ。ふふふ..."
-
-            # ✅ どのキーワードにも当てはまらない場合、通常の会話処理
-            else:
-                with st.spinner("キャラクターが考えてるよ..."):
-                    chat_session = text_model.start_chat(history=chat_history_for_gemini[:-1])
-                    response = chat_session.send_message(user_input)
-                    ai_response_text = response.text
-
-            print(f"AI Text Response: {ai_response_text}")
-
-            # AIの返答を履歴に追加
-            st.session_state.messages.append({"role": "model", "parts": [ai_response_text]})
-    
-        except Exception as e:
-            st.error(f"ごめんなさい、お話の途中でエラーが出ちゃったの...: {e}")
-            st.session_state.messages.append({"role": "model", "parts": [f"エラーが発生したよ: {e}"]})
 
-# ユーザーからの入力を受け取る部分
-st.chat_input("メッセージを入力してね...", on_submit=handle_user_input, key="user_chat_input_key")
+# ✅ 会話の部分だけをフラグメントにして、送信してもサイドバーやプリセット表は再実行しない
+@st.fragment
+def chat_area():
+    render_start = time.perf_counter()
+
+    # ✅ フラグメントの中の入力欄は画面の下に固定されず、その場に置かれる
+    # 新しい吹き出しが入力欄より上に出るよう、履歴はこの入れ物に描いて、あとから書き足す
+    history = st.container()
+
+    # これまでの会話を表示（最近の分だけ。性格プロンプトは表示しない）
+    hidden_count, window = visible_messages(st.session_state.messages, st.session_state.visible_messages)
+    with history:
+        if hidden_count:
+            st.button(f"もっと前の会話を見る（あと{hidden_count}件）", on_click=show_earlier_messages)
+        for message in window:
+            render_message(message)
+
+    # ✅ 履歴を描き終えるまでの時間（初回表示の速さの確認用。AI_TURN_TIMING=1 のときだけ出す）
+    script_start = st.session_state.pop("script_start_time", None)
+    if script_start is not None:
+        turn_timing.log("first_paint", ms=round((time.perf_counter() - script_start) * 1000, 1))
+    turn_timing.log("chat_render", ms=round((time.perf_counter() - render_start) * 1000, 1), messages=len(window))
+
+    # ユーザーからの入力を受け取る部分
+    # ✅ 履歴の下に新しい吹き出しを出すため、コールバックではなく本体で処理する
+    if user_input := st.chat_input("メッセージを入力してね...", key="user_chat_input_key"):
+        with history:
+            handle_user_input(user_input)
+
+
+# フラグメントだけの再実行では SCRIPT_START_TIME が古いままなので、全体の実行のときだけ渡す
+st.session_state.script_start_time = SCRIPT_START_TIME
+chat_area()
 
 # 背景画像設定のHTMLを削除
 st.markdown("<style>body { background-image: none; }</style>", unsafe_allow_html=True)
@@ -0,0 +1,150 @@
+# GeminiとYouTubeの呼び出し先を切り替える
+# 環境変数 AI_BACKEND=fake にすると、通信しない偽物を使う（負荷試験・ベンチマーク用）
+#
+# 偽物の動きは環境変数で変えられる:
+#   FAKE_MODEL_FIRST_CHUNK_SECONDS  最初のチャンクが届くまでの秒数（既定 0.3）
+#   FAKE_MODEL_CHUNK_SECONDS        2つ目以降のチャンクの間隔（既定 0.05）
+#   FAKE_MODEL_CHUNKS               1回の返答のチャンク数（既定 8）
+#   FAKE_MODEL_ERROR_RATE           返答の前に失敗する割合（既定 0）
+#   FAKE_MODEL_RATE_LIMIT_RATE      返答の前に429を返す割合（既定 0）
+#   FAKE_MODEL_CUTOFF_RATE          返答の途中で切れる割合（既定 0）
+#   FAKE_YOUTUBE_SECONDS            YouTube検索1回の秒数（既定 0.2）
+#   FAKE_YOUTUBE_ERROR_RATE         YouTube検索が失敗する割合（既定 0）
+import os
+import random
+import time
+
+BACKEND = os.environ.get("AI_BACKEND", "gemini")
+
+
+def _env_float(name, default):
+    return float(os.environ.get(name, default))
+
+
+class FakeBackendError(Exception):
+    pass
+
+
+class FakeRateLimitError(FakeBackendError):
+    # google.api_core の ResourceExhausted と同じく code が 429
+    code = 429
+
+
+class _FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeTextModel:
+    """genai.GenerativeModel の generate_content だけを真似する偽物。"""
+
+    def __init__(self, model_name, system_instruction=None, first_chunk_seconds=0.3, chunk_seconds=0.05,
+                 chunks=8, error_rate=0.0, rate_limit_rate=0.0, cutoff_rate=0.0):
+        self.model_name = model_name
+        self.system_instruction = system_instruction
+        self.first_chunk_seconds = first_chunk_seconds
+        self.chunk_seconds = chunk_seconds
+        self.chunks = chunks
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.cutoff_rate = cutoff_rate
+
+    @classmethod
+    def from_env(cls, model_name, system_instruction=None):
+        return cls(
+            model_name,
+            system_instruction,
+            first_chunk_seconds=_env_float("FAKE_MODEL_FIRST_CHUNK_SECONDS", 0.3),
+            chunk_seconds=_env_float("FAKE_MODEL_CHUNK_SECONDS", 0.05),
+            chunks=int(_env_float("FAKE_MODEL_CHUNKS", 8)),
+            error_rate=_env_float("FAKE_MODEL_ERROR_RATE", 0),
+            rate_limit_rate=_env_float("FAKE_MODEL_RATE_LIMIT_RATE", 0),
+            cutoff_rate=_env_float("FAKE_MODEL_CUTOFF_RATE", 0),
+        )
+
+    def generate_content(self, contents, stream=False, **kwargs):
+        # 本物と同じく、最初のチャンクが届くまではここで待つ
+        time.sleep(self.first_chunk_seconds)
+        if random.random() < self.rate_limit_rate:
+            raise FakeRateLimitError("429 Resource has been exhausted (fake)")
+        if random.random() < self.error_rate:
+            raise FakeBackendError("偽のモデルがわざと失敗したよ")
+        cut_at = random.randrange(1, self.chunks) if self.chunks > 1 and random.random() < self.cutoff_rate else None
+        chunks = [f"（{len(contents)}件の履歴を読んだ偽の返事 {i + 1}/{self.chunks}）" for i in range(self.chunks)]
+        if not stream:
+            time.sleep(self.chunk_seconds * (self.chunks - 1))
+            if cut_at is not None:
+                raise FakeBackendError("偽のモデルの返事が途中で切れたよ")
+            return _FakeResponse("".join(chunks))
+        return self._stream(chunks, cut_at)
+
+    def _stream(self, chunks, cut_at):
+        for i, chunk in enumerate(chunks):
+            if i == cut_at:
+                raise FakeBackendError("偽のモデルの返事が途中で切れたよ")
+            if i:
+                time.sleep(self.chunk_seconds)
+            yield _FakeResponse(chunk)
+
+
+class _FakeRequest:
+    def __init__(self, client, q, maxResults=5, **kwargs):
+        self._client = client
+        self._query = q
+        self._max_results = maxResults
+
+    def execute(self):
+        time.sleep(self._client.seconds)
+        self._client.calls += 1
+        if random.random() < self._client.error_rate:
+            raise FakeBackendError("偽のYouTube検索がわざと失敗したよ")
+        return {
+            "items": [
+                {"snippet": {"title": f"{self._query} の動画 {i + 1}", "channelTitle": f"偽チャンネル{i + 1}"}}
+                for i in range(self._max_results)
+            ]
+        }
+
+
+class _FakeSearch:
+    def __init__(self, client):
+        self._client = client
+
+    def list(self, **kwargs):
+        return _FakeRequest(self._client, **kwargs)
+
+
+class FakeYouTubeClient:
+    """youtube.search().list(...).execute() だけを真似する偽物。"""
+
+    def __init__(self, seconds=0.2, error_rate=0.0):
+        self.seconds = seconds
+        self.error_rate = error_rate
+        self.calls = 0
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            seconds=_env_float("FAKE_YOUTUBE_SECONDS", 0.2),
+            error_rate=_env_float("FAKE_YOUTUBE_ERROR_RATE", 0),
+        )
+
+    def search(self):
+        return _FakeSearch(self)
+
+
+def make_text_model(api_key, model_name, system_instruction=None):
+    if BACKEND == "fake":
+        return FakeTextModel.from_env(model_name, system_instruction)
+    import google.generativeai as genai
+
+    genai.configure(api_key=api_key)
+    return genai.GenerativeModel(model_name, system_instruction=system_instruction)
+
+
+def make_youtube_client(api_key):
+    if BACKEND == "fake":
+        return FakeYouTubeClient.from_env()
+    from googleapiclient.discovery import build
+
+    return build('youtube', 'v3', developerKey=api_key, cache_discovery=False)
@@ -0,0 +1,203 @@
+# 偽のGemini/YouTube（backends.py）に対して、大勢のセッションから同時に話しかける負荷試験
+#
+#   python benchmarks/bench_app.py [セッション数] [1セッションのターン数] [プロセス数] [--mode threads|apptest]
+#
+# --mode threads（既定）: 1つのプロセスの中で、セッション数だけのスレッドが同時に
+#   app.py の handle_user_input と同じ services.run_turn() を呼ぶ。
+#   本番と同じく全セッションが1つのスケジューラと検索キャッシュを取り合うので、
+#   p95/p99 には順番待ちの時間がそのまま出る。
+# --mode apptest: app.py の画面を AppTest で動かし、キャラクター切り替えや検索を含む
+#   一連の流れが最後まで通るかを確かめる。AppTest は実行のたびにStreamlitの全体設定を
+#   差し替えるので同じプロセスでは同時に動かせず、プロセスごとにセッションを順番に進める
+#   （スケジューラや検索キャッシュもプロセスごとなので、混み具合の測定には使わない）。
+#
+# 1ターンごとの記録は turn_timing から受け取り、分岐ごとの p50/p95/p99、
+# スループット、メモリ使用量をまとめて表示する。偽物の遅延や失敗の割合は
+# backends.py にある環境変数で変えられる。
+import argparse
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+os.environ.setdefault("AI_BACKEND", "fake")
+os.environ.setdefault("FAKE_MODEL_FIRST_CHUNK_SECONDS", "0.3")
+os.environ.setdefault("FAKE_MODEL_CHUNK_SECONDS", "0.03")
+os.environ.setdefault("FAKE_MODEL_RATE_LIMIT_RATE", "0.05")
+os.environ.setdefault("FAKE_MODEL_CUTOFF_RATE", "0.02")
+# 1人が速く送りすぎて弾かれないよう、負荷試験ではセッションごとの上限をゆるめる
+os.environ.setdefault("REQUESTS_PER_MINUTE_PER_SESSION", "600")
+
+from streamlit.testing.v1 import AppTest
+
+import turn_timing
+from chat_state import ChatState
+from services import get_scheduler, get_search_cache, get_text_model, run_turn
+
+APP_PATH = os.path.join(ROOT, "app.py")
+# threads モードで使う、app.py と同じモデル名・会話の予算
+TEXT_MODEL_NAME = "gemini-2.5-flash"
+CONTEXT_TOKEN_BUDGET = 8000
+PRESETS = ["当たり障りのないAI", "AI教師", "博麗霊夢", "密室殺人ゲーム", "久保田雄大"]
+SEARCH_QUERIES = ["Python tutorial", "東方 BGM", "ドグラ・マグラ 朗読", "二次関数"]
+
+
+def user_message(session_index, turn):
+    if turn % 5 == 4:
+        return f"{SEARCH_QUERIES[(session_index + turn) % len(SEARCH_QUERIES)]} 検索"
+    if turn % 7 == 6:
+        return "このPCをハッキングして"
+    return f"{turn}ターン目のメッセージだよ。調子はどう？"
+
+
+def threaded_turn(session_id, preset, chat_state, text):
+    # app.py の handle_user_input と同じ services.run_turn を呼ぶ（記録は turn_timing から受け取る）
+    try:
+        run_turn(session_id, preset, chat_state, text)
+    except Exception:
+        pass
+
+
+def run_threaded_session(session_index, turns, start_gate):
+    session_id = f"bench-{session_index}"
+    summary_model = get_text_model("fake", TEXT_MODEL_NAME)
+    chat_states = {}
+    start_gate.wait()
+    for turn in range(turns):
+        # 4ターンごとにキャラクターを切り替える（会話はプリセットごとに続ける）
+        preset = PRESETS[(session_index + turn // 4) % len(PRESETS)]
+        if preset not in chat_states:
+            chat_states[preset] = ChatState(
+                get_text_model("fake", TEXT_MODEL_NAME, f"{preset}の性格プロンプト"),
+                [{"role": "model", "parts": [f"{preset}だよ。"]}],
+                token_budget=CONTEXT_TOKEN_BUDGET,
+                summary_model=summary_model,
+                scheduler=get_scheduler(),
+            )
+        threaded_turn(session_id, preset, chat_states[preset], user_message(session_index, turn))
+    return sum(chat_state.memory_bytes() for chat_state in chat_states.values()) / 1024
+
+
+def run_threads(sessions, turns):
+    # 1つのプロセスの中で、全セッションを同時に動かす（共有のスケジューラと検索キャッシュを取り合う）
+    records = []
+    turn_timing.add_listener(records.append)
+    start_gate = threading.Barrier(sessions)
+    tracemalloc.start()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=sessions) as executor:
+        futures = [executor.submit(run_threaded_session, i, turns, start_gate) for i in range(sessions)]
+        session_kb = [future.result() for future in futures]
+    elapsed = time.perf_counter() - start
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    turn_timing.remove_listener(records.append)
+
+    print(f"mode: threads  sessions: {sessions}  turns: {len(records)}  elapsed: {elapsed:.1f}s  "
+          f"throughput: {len(records) / elapsed:.1f} turns/s")
+    report(records)
+    print(f"scheduler: {get_scheduler().metrics()}")
+    print(f"search cache: {get_search_cache().stats()}")
+    print(f"memory: python peak {peak_bytes / 1024 / 1024:.1f} MiB, "
+          f"max RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB; "
+          f"conversations per session avg {sum(session_kb) / max(len(session_kb), 1):.1f} KiB")
+
+
+def run_session(session_index, turns):
+    app = AppTest.from_file(APP_PATH, default_timeout=300)
+    app.secrets["GOOGLE_API_KEY"] = "fake"
+    app.run()
+    for turn in range(turns):
+        # 4ターンごとにキャラクターを切り替える
+        if turn % 4 == 0:
+            app.sidebar.radio[0].set_value(PRESETS[(session_index + turn // 4) % len(PRESETS)])
+        app.chat_input[0].set_value(user_message(session_index, turn)).run()
+        if app.exception:
+            raise RuntimeError(app.exception)
+    return app.session_state.conversations.memory_report()["合計"]["kb"]
+
+
+def run_sessions(session_indices, turns):
+    # 1つのプロセスで、割り当てられたセッションを順番に動かす
+    records = []
+    turn_timing.add_listener(records.append)
+    tracemalloc.start()
+    session_kb = [run_session(session_index, turns) for session_index in session_indices]
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    max_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return records, session_kb, peak_bytes, max_rss_kb
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+def report(records):
+    print(f"{'branch':>8} {'turns':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'first chunk p95':>16} {'queue p95':>10}")
+    for branch in ["all", "model", "search", "hacking"]:
+        group = [r for r in records if branch == "all" or r["branch"] == branch]
+        if not group:
+            continue
+        totals = [r["total_ms"] for r in group]
+        first_chunks = [r["first_chunk_ms"] for r in group if "first_chunk_ms" in r]
+        queue_waits = [r["queue_wait_ms"] for r in group if "queue_wait_ms" in r]
+        print(f"{branch:>8} {len(group):>6} {percentile(totals, 0.5):>8.0f} {percentile(totals, 0.95):>8.0f} "
+              f"{percentile(totals, 0.99):>8.0f} "
+              f"{percentile(first_chunks, 0.95) if first_chunks else 0:>16.0f} "
+              f"{percentile(queue_waits, 0.95) if queue_waits else 0:>10.0f}")
+    statuses = {}
+    for record in records:
+        statuses[record["status"]] = statuses.get(record["status"], 0) + 1
+    print(f"status: {statuses}")
+
+
+def run_apptest(sessions, turns, processes):
+    records = []
+    session_kb = []
+    peak_bytes = []
+    max_rss_kb = []
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [
+            executor.submit(run_sessions, list(range(i, sessions, processes)), turns)
+            for i in range(processes)
+        ]
+        for future in futures:
+            process_records, process_kb, process_peak, process_rss = future.result()
+            records.extend(process_records)
+            session_kb.extend(process_kb)
+            peak_bytes.append(process_peak)
+            max_rss_kb.append(process_rss)
+    elapsed = time.perf_counter() - start
+
+    print(f"mode: apptest  sessions: {sessions}  processes: {processes}  turns: {len(records)}  "
+          f"elapsed: {elapsed:.1f}s  throughput: {len(records) / elapsed:.1f} turns/s")
+    report(records)
+    print(f"memory per process: python peak {max(peak_bytes) / 1024 / 1024:.1f} MiB, "
+          f"max RSS {max(max_rss_kb) / 1024:.1f} MiB; "
+          f"conversations per session avg {sum(session_kb) / max(len(session_kb), 1):.1f} KiB")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("sessions", nargs="?", type=int, default=20)
+    parser.add_argument("turns", nargs="?", type=int, default=10)
+    parser.add_argument("processes", nargs="?", type=int, help="apptest モードのプロセス数")
+    parser.add_argument("--mode", choices=["threads", "apptest"], default="threads")
+    args = parser.parse_args()
+    if args.mode == "threads":
+        run_threads(args.sessions, args.turns)
+    else:
+        run_apptest(args.sessions, args.turns, args.processes or min(args.sessions, os.cpu_count() or 1))
+
+
+if __name__ == "__main__":
+    main()
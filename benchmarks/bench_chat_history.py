@@ -0,0 +1,86 @@
+# 1ターンあたりの履歴処理コストを、旧方式（毎ターン全履歴を作り直す）と
+# ChatState（変換済み履歴に追記する）で比べるベンチマーク
+#
+#   python benchmarks/bench_chat_history.py
+#
+# モデルは通信しない偽物。SDKと同じく送られてきた履歴を Content に変換するところまでは行う。
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from google.generativeai.types import content_types
+
+from chat_state import ChatState
+
+TURN_COUNTS = [10, 50, 100, 200, 300, 500]
+SAMPLES = 20
+USER_TEXT = "今日はどんな授業をするの？" * 5
+MODEL_TEXT = "うーし、今日は数学の授業をはじめるぞー。まずは一次関数からだ。" * 10
+
+
+class FakeModel:
+    def generate_content(self, contents, stream=False):
+        return content_types.to_contents(contents)
+
+    def start_chat(self, history):
+        return content_types.to_contents(history)
+
+
+def build_messages(turns):
+    messages = [{"role": "user", "parts": ["性格プロンプト" * 200]}, {"role": "model", "parts": ["こんにちは"]}]
+    for _ in range(turns):
+        messages.append({"role": "user", "parts": [USER_TEXT]})
+        messages.append({"role": "model", "parts": [MODEL_TEXT]})
+    return messages
+
+
+def old_turn(model, messages):
+    # 旧 handle_user_input と同じ処理
+    messages.append({"role": "user", "parts": [USER_TEXT]})
+    chat_history_for_gemini = []
+    for msg in messages:
+        text_parts = []
+        for part in msg["parts"]:
+            if isinstance(part, str):
+                text_parts.append(part)
+            elif isinstance(part, dict) and 'text' in part:
+                text_parts.append(part['text'])
+        if text_parts:
+            chat_history_for_gemini.append({"role": msg["role"], "parts": [{"text": " ".join(text_parts)}]})
+    model.start_chat(history=chat_history_for_gemini[:-1])
+    messages.append({"role": "model", "parts": [MODEL_TEXT]})
+
+
+def new_turn(chat_state, messages):
+    messages.append({"role": "user", "parts": [USER_TEXT]})
+    chat_state.send(USER_TEXT)
+    messages.append({"role": "model", "parts": [MODEL_TEXT]})
+    chat_state.commit(USER_TEXT, MODEL_TEXT)
+
+
+def per_turn_ms(run_turn):
+    timings = []
+    for _ in range(SAMPLES):
+        start = time.perf_counter()
+        run_turn()
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return timings[len(timings) // 2] * 1000
+
+
+def main():
+    model = FakeModel()
+    print(f"{'turns':>6} {'old (ms/turn)':>14} {'ChatState (ms/turn)':>20}")
+    for turns in TURN_COUNTS:
+        old_messages = build_messages(turns)
+        new_messages = build_messages(turns)
+        chat_state = ChatState(model, new_messages)
+        old_ms = per_turn_ms(lambda: old_turn(model, old_messages))
+        new_ms = per_turn_ms(lambda: new_turn(chat_state, new_messages))
+        print(f"{turns:>6} {old_ms:>14.3f} {new_ms:>20.3f}")
+
+
+if __name__ == "__main__":
+    main()
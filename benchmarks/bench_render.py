@@ -0,0 +1,82 @@
+# 会話の長さごとに、履歴を描く時間を旧方式（全件描画＋性格プロンプトと文字列比較）と
+# 新方式（最近の分だけ描画＋persona の印で判定）で比べるベンチマーク
+#
+#   python benchmarks/bench_render.py
+#
+# Streamlitの AppTest で実際に chat_message / write を描かせて、1回の再実行の時間を測る。
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from streamlit.testing.v1 import AppTest
+
+TURN_COUNTS = [50, 500, 2000]
+WINDOW = 40
+SAMPLES = 5
+PERSONA = "性格プロンプト" * 300
+
+
+def old_render(persona):
+    import streamlit as st
+
+    for message in st.session_state.messages:
+        if message["role"] == "user":
+            if message["parts"][0] != persona:
+                with st.chat_message("user"):
+                    st.write(message["parts"][0])
+        elif message["role"] == "model":
+            with st.chat_message("assistant"):
+                for part in message["parts"]:
+                    if isinstance(part, str):
+                        st.write(part)
+
+
+def new_render(root, window):
+    import sys
+
+    import streamlit as st
+
+    sys.path.insert(0, root)
+    from conversations import visible_messages
+
+    hidden_count, messages = visible_messages(st.session_state.messages, window)
+    if hidden_count:
+        st.button(f"もっと前の会話を見る（あと{hidden_count}件）")
+    for message in messages:
+        with st.chat_message("user" if message["role"] == "user" else "assistant"):
+            st.write(message["parts"][0])
+
+
+def build_messages(turns):
+    messages = [{"role": "user", "parts": [PERSONA], "persona": True}]
+    for i in range(turns):
+        messages.append({"role": "user", "parts": [f"{i}番目の質問だよ"]})
+        messages.append({"role": "model", "parts": [f"{i}番目の答えだよ。" * 5]})
+    return messages
+
+
+def render_ms(app, messages):
+    timings = []
+    for _ in range(SAMPLES):
+        app.session_state["messages"] = messages
+        start = time.perf_counter()
+        app.run()
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return timings[len(timings) // 2] * 1000
+
+
+def main():
+    print(f"{'turns':>6} {'full render (ms)':>17} {'windowed (ms)':>14}")
+    for turns in TURN_COUNTS:
+        messages = build_messages(turns)
+        old_app = AppTest.from_function(old_render, args=(PERSONA,), default_timeout=600)
+        new_app = AppTest.from_function(new_render, args=(ROOT, WINDOW), default_timeout=600)
+        print(f"{turns:>6} {render_ms(old_app, messages):>17.1f} {render_ms(new_app, messages):>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+# セーブコードの長さと作成・読み込みにかかる時間を会話の長さごとに測る
+# あわせて、読み込んだ会話が保存前と同じになるかも確かめる
+#
+#   python benchmarks/bench_save_code.py
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from save_code import decode_save_code, encode_save_code
+
+TURN_COUNTS = [1, 10, 50, 200, 1000]
+PRESET_NAME = "AI教師"
+
+
+def build_messages(turns):
+    messages = [{"role": "user", "parts": ["性格プロンプト"], "persona": True}, {"role": "model", "parts": ["うーし、授業はじめるぞー。"]}]
+    for i in range(turns):
+        messages.append({"role": "user", "parts": [f"{i}問目：二次関数の頂点ってどうやって求めるの？"]})
+        messages.append({"role": "model", "parts": [f"いい質問だ！{i}問目は平方完成で y=a(x-p)^2+q の形にすれば、頂点は (p, q) だぞ。"]})
+    return messages
+
+
+def main():
+    print(f"{'turns':>6} {'json bytes':>11} {'code chars':>11} {'encode ms':>10} {'decode ms':>10}")
+    for turns in TURN_COUNTS:
+        messages = build_messages(turns)
+        raw_size = len(json.dumps(messages[1:], ensure_ascii=False).encode("utf-8"))
+
+        start = time.perf_counter()
+        code = encode_save_code(PRESET_NAME, messages)
+        encode_ms = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        preset_name, loaded_messages = decode_save_code(code)
+        decode_ms = (time.perf_counter() - start) * 1000
+
+        if (preset_name, loaded_messages) != (PRESET_NAME, messages[1:]):
+            raise SystemExit(f"{turns}ターンの会話が元に戻らなかった")
+        print(f"{turns:>6} {raw_size:>11} {len(code):>11} {encode_ms:>10.2f} {decode_ms:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
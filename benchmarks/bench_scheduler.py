@@ -0,0 +1,72 @@
+# スケジューラを、遅延と429を返す偽のモデルに対して動かすベンチマーク
+# 大勢のセッションが同時に送ったときの待ち時間・やり直し回数・公平さを確かめる
+#
+#   python benchmarks/bench_scheduler.py
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backends import FakeTextModel
+from scheduler import RateLimited, Scheduler
+
+SESSIONS = 30
+MESSAGES_PER_SESSION = 3
+MAX_CONCURRENCY = 4
+
+
+def run_session(scheduler, model, session_id, latencies, lock):
+    for _ in range(MESSAGES_PER_SESSION):
+        def job(ticket):
+            for chunk in model.generate_content([], stream=True):
+                ticket.emit(chunk.text)
+
+        start = time.perf_counter()
+        while True:
+            try:
+                ticket = scheduler.submit(session_id, job)
+                break
+            except RateLimited as e:
+                time.sleep(e.retry_after)
+        first_chunk = None
+        for chunk in ticket.stream(poll_interval=0.01):
+            if chunk is not None and first_chunk is None:
+                first_chunk = time.perf_counter() - start
+        with lock:
+            latencies.append((first_chunk, time.perf_counter() - start))
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)] * 1000
+
+
+def main():
+    scheduler = Scheduler(max_concurrency=MAX_CONCURRENCY, rate_per_minute=600, burst=5, base_delay=0.05, max_delay=1.0)
+    # 通信せず、少し待ってからチャンクを返す。1割は429を返す
+    model = FakeTextModel("fake", first_chunk_seconds=0.05, chunk_seconds=0.05, chunks=4, rate_limit_rate=0.1)
+    latencies = []
+    lock = threading.Lock()
+    threads = [
+        threading.Thread(target=run_session, args=(scheduler, model, f"session-{i}", latencies, lock))
+        for i in range(SESSIONS)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    first_chunks = [first for first, _ in latencies]
+    totals = [total for _, total in latencies]
+    print(f"requests: {len(latencies)}  elapsed: {elapsed:.2f}s  throughput: {len(latencies) / elapsed:.1f} req/s")
+    print(f"first chunk p50/p95: {percentile(first_chunks, 0.5):.0f} / {percentile(first_chunks, 0.95):.0f} ms")
+    print(f"total       p50/p95: {percentile(totals, 0.5):.0f} / {percentile(totals, 0.95):.0f} ms")
+    print(scheduler.metrics())
+
+
+if __name__ == "__main__":
+    main()
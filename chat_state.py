@@ -0,0 +1,198 @@
+# セッションごとに持ち続けるGeminiとの会話状態
+# 毎ターン履歴を作り直さず、新しいユーザー発言とAIの返答だけを追記していく
+# 長くなった会話は、古いターンから要約にまとめて送る量を一定に保つ
+from collections import deque
+
+from google.generativeai import protos
+
+import turn_timing
+from scheduler import SchedulerError
+
+# 要約をスケジューラに預けるときのセッション名（裏の仕事なのでセッションごとの制限は受けない）
+SUMMARY_SESSION_ID = "chat-summary"
+
+SUMMARY_PROMPT = (
+    "次の「これまでの要約」と「新しい会話」をまとめて、会話の続きに必要な事実・約束・登場人物・"
+    "キャラクターの口調や状態がわかる短い要約を日本語で書いてください。要約だけを出力してください。"
+)
+
+
+def to_gemini_content(role, text):
+    return protos.Content(role=role, parts=[protos.Part(text=text)])
+
+
+def message_text(message):
+    # st.session_state.messages の1件からテキスト部分だけを取り出す
+    text_parts = []
+    for part in message["parts"]:
+        if isinstance(part, str):
+            text_parts.append(part)
+        elif isinstance(part, dict) and 'text' in part:
+            text_parts.append(part['text'])
+    return " ".join(text_parts)
+
+
+def estimate_tokens(text):
+    # 通信せずに使える大まかなトークン数の見積もり
+    # 日本語などの非ASCII文字は1文字1トークン、英数字は4文字で1トークンくらいとして数える
+    ascii_chars = sum(1 for ch in text if ch.isascii())
+    return (len(text) - ascii_chars) + (ascii_chars + 3) // 4 + 1
+
+
+def summarize_turns(model, summary, turns):
+    # これまでの要約に、あふれたターンだけを足して新しい要約を作る
+    lines = [f"これまでの要約:\n{summary or '（なし）'}", "新しい会話:"]
+    for role, text in turns:
+        speaker = "ユーザー" if role == "user" else "キャラクター"
+        lines.append(f"{speaker}: {text}")
+    response = model.generate_content([SUMMARY_PROMPT, "\n".join(lines)])
+    return response.text.strip()
+
+
+def alternating_turns(messages):
+    """表示用のメッセージから、Geminiに送れる形の (最初のあいさつ, [(role, text), ...]) を作る。
+
+    Geminiには user → model → user ... と交互に、user から始まるように送る必要がある。
+    空のメッセージは飛ばし、同じ役が続いたら1つにまとめる。
+    先頭の model だけの発言（キャラクターのあいさつ）は別に返し、最後の返事のない user は捨てる。
+    """
+    turns = []
+    for message in messages:
+        text = message_text(message)
+        if not text:
+            continue
+        if turns and turns[-1][0] == message["role"]:
+            turns[-1] = (message["role"], f"{turns[-1][1]}\n{text}")
+        else:
+            turns.append((message["role"], text))
+    opening = turns.pop(0)[1] if turns and turns[0][0] == "model" else ""
+    if turns and turns[-1][0] == "user":
+        turns.pop()
+    return opening, turns
+
+
+class ChatState:
+    """Geminiに送る形式に変換済みの履歴と、それを使って返答を作るモデルの組。
+
+    履歴は作成時に一度だけ変換し、その後は commit() で1ターンずつ追記する。
+    返答が最後まで届かなかったターンは commit() しないので、履歴に残らない。
+    性格プロンプトは model 側の system_instruction で渡し、履歴には入れない。
+
+    token_budget を超えた古いターンは summary_model で要約にまとめる。
+    要約は scheduler に裏の仕事として預け（同時実行数と429のやり直しを返答と共有する）、
+    出来上がるまではあふれたターンをそのまま送る。scheduler がなければ古いターンは捨てる。
+    要約が失敗し続けても送る量が増え続けないよう、そのまま送るターンは token_budget の半分までにし、
+    それを超えたら古い方から1往復ずつ捨てる。
+
+    送る内容は必ず user から始まり、user と model が交互になる。
+    そのため古いターンは1往復ずつ外し、最初のあいさつは要約の先頭に入れておく。
+    """
+
+    def __init__(self, model, messages=(), token_budget=8000, summary_model=None, scheduler=None):
+        self.model = model
+        self.token_budget = token_budget
+        self.summary_model = summary_model
+        self.scheduler = scheduler
+
+        self.history = deque()  # (Content, トークン数)
+        self.history_tokens = 0
+        self.summary = ""
+        self.summary_tokens = 0
+        self._overflow = []  # 要約待ちの (Content, トークン数)
+        self._overflow_tokens = 0
+        self._summary_job = None  # (Ticket, 要約に渡したターン数)
+
+        opening, turns = alternating_turns(messages)
+        if opening:
+            self.summary = f"（キャラクターの最初のあいさつ）{opening}"
+            self.summary_tokens = estimate_tokens(self.summary)
+        for role, text in turns:
+            self._append(role, text)
+        self._trim()
+
+    def send(self, user_text, stream=False):
+        # ✅ 要約 + 要約待ちのターン + 最近のターン + 今回の発言だけを送る
+        self._collect_summary()
+        return self.model.generate_content(self.contents(user_text), stream=stream)
+
+    def commit(self, user_text, model_text):
+        self._append("user", user_text)
+        self._append("model", model_text)
+        self._trim()
+
+    def contents(self, user_text):
+        contents = []
+        if self.summary:
+            contents.append(to_gemini_content("user", f"（ここまでの会話の要約）\n{self.summary}"))
+            contents.append(to_gemini_content("model", "わかった。この続きから話すね。"))
+        contents.extend(content for content, _ in self._overflow)
+        contents.extend(content for content, _ in self.history)
+        contents.append(to_gemini_content("user", user_text))
+        return contents
+
+    def context_tokens(self):
+        return self.summary_tokens + self._overflow_tokens + self.history_tokens
+
+    def memory_bytes(self):
+        # 持っている履歴と要約のおおよそのバイト数
+        contents = [content for content, _ in self.history] + [content for content, _ in self._overflow]
+        return sum(type(content).pb(content).ByteSize() for content in contents) + len(self.summary.encode("utf-8"))
+
+    def __len__(self):
+        return len(self.history)
+
+    def _append(self, role, text):
+        tokens = estimate_tokens(text)
+        self.history.append((to_gemini_content(role, text), tokens))
+        self.history_tokens += tokens
+
+    def _trim(self):
+        # ✅ 予算を超えた分を古い方から1往復ずつ要約待ちへ回す（最新の1往復は必ず残す）
+        while len(self.history) > 2 and self.summary_tokens + self.history_tokens > self.token_budget:
+            for _ in range(2):
+                content, tokens = self.history.popleft()
+                self.history_tokens -= tokens
+                if self.summary_model is not None and self.scheduler is not None:
+                    self._overflow.append((content, tokens))
+                    self._overflow_tokens += tokens
+        # 先に要約に渡してから捨てるので、要約ができれば捨てたターンも要約に残る
+        self._collect_summary()
+        self._drop_overflow()
+
+    def _drop_overflow(self):
+        # ✅ 要約待ちが token_budget の半分を超えたら、古い方から1往復ずつ要約せずに捨てる
+        while len(self._overflow) >= 2 and self._overflow_tokens > self.token_budget // 2:
+            for _ in range(2):
+                _, tokens = self._overflow.pop(0)
+                self._overflow_tokens -= tokens
+            if self._summary_job is not None:
+                # 作成中の要約に渡した分も前から減ったので、数をずらしておく
+                ticket, used = self._summary_job
+                self._summary_job = (ticket, max(used - 2, 0))
+
+    def _collect_summary(self):
+        if self._summary_job is not None:
+            ticket, used = self._summary_job
+            if not ticket.done.is_set():
+                return
+            self._summary_job = None
+            if ticket.error is not None:
+                # 要約に失敗したらターンはそのまま残し、次の機会にやり直す
+                turn_timing.log("summary_failed", error=f"{type(ticket.error).__name__}: {ticket.error}")
+            else:
+                self.summary = ticket.result
+                self.summary_tokens = estimate_tokens(self.summary)
+                self._overflow_tokens -= sum(tokens for _, tokens in self._overflow[:used])
+                del self._overflow[:used]
+
+        if self._overflow:
+            model, summary = self.summary_model, self.summary
+            turns = [(content.role, content.parts[0].text) for content, _ in self._overflow]
+            try:
+                ticket = self.scheduler.submit(
+                    SUMMARY_SESSION_ID, lambda ticket: summarize_turns(model, summary, turns), background=True
+                )
+            except SchedulerError as e:
+                turn_timing.log("summary_failed", error=f"{type(e).__name__}: {e}")
+                return
+            self._summary_job = (ticket, len(turns))
@@ -0,0 +1,85 @@
+# セッションごとに、訪れたプリセットの会話を覚えておく入れ物
+# キャラクターを切り替えて戻ってきても、作り直さずにすぐ続きから話せる
+import sys
+from collections import OrderedDict
+
+
+def visible_messages(messages, limit):
+    """表示する最近の limit 件と、その前に隠れている件数を返す。
+
+    性格プロンプト（persona の印がついたメッセージ）は表示しないので数えない。
+    全件をたどらないよう、性格プロンプトは先頭にしかない前提で数える。
+    """
+    start = max(len(messages) - limit, 0)
+    window = [message for message in messages[start:] if not message.get("persona")]
+    hidden_count = start
+    if start and messages[0].get("persona"):
+        hidden_count -= 1
+    return hidden_count, window
+
+
+class Conversation:
+    # 1つのプリセットとの会話（表示用の履歴と、Geminiに送る会話状態）
+    def __init__(self, messages, chat_state):
+        self.messages = messages
+        self.chat_state = chat_state
+
+    def memory_bytes(self):
+        # 表示用の履歴と、Geminiに送る会話状態のおおよそのバイト数
+        total = sys.getsizeof(self.messages)
+        for message in self.messages:
+            total += sys.getsizeof(message) + sys.getsizeof(message["parts"])
+            total += sum(sys.getsizeof(part) for part in message["parts"])
+        return total + self.chat_state.memory_bytes()
+
+
+class ConversationStore:
+    """プリセット名ごとの Conversation を、最近使った順に max_presets 個まで持つ。
+
+    1つの会話の表示用履歴は max_messages 件まで。あふれた古いメッセージは捨てる
+    （Geminiに送る側は ChatState が要約して持っているので、会話の流れは続く）。
+    """
+
+    def __init__(self, max_presets=4, max_messages=400):
+        self.max_presets = max_presets
+        self.max_messages = max_messages
+        self._conversations = OrderedDict()
+
+    def get(self, preset_name):
+        conversation = self._conversations.get(preset_name)
+        if conversation is not None:
+            self._conversations.move_to_end(preset_name)
+        return conversation
+
+    def put(self, preset_name, conversation):
+        # ✅ 一番長く使っていないプリセットから忘れる
+        self._conversations[preset_name] = conversation
+        self._conversations.move_to_end(preset_name)
+        while len(self._conversations) > self.max_presets:
+            self._conversations.popitem(last=False)
+
+    def trim(self, conversation):
+        # 先頭の性格プロンプトは残して、古いメッセージから捨てる
+        overflow = len(conversation.messages) - self.max_messages
+        if overflow > 0:
+            del conversation.messages[1:1 + overflow]
+
+    def memory_report(self):
+        report = {
+            preset_name: {
+                "messages": len(conversation.messages),
+                "kb": round(conversation.memory_bytes() / 1024, 1),
+            }
+            for preset_name, conversation in self._conversations.items()
+        }
+        report["合計"] = {
+            "messages": sum(entry["messages"] for entry in report.values()),
+            "kb": round(sum(entry["kb"] for entry in report.values()), 1),
+        }
+        return report
+
+    def __contains__(self, preset_name):
+        return preset_name in self._conversations
+
+    def __len__(self):
+        return len(self._conversations)
@@ -0,0 +1,86 @@
+# 会話を短いセーブコードにしたり、セーブコードから会話を戻したりする
+# AIに16進数を作らせる代わりに、手元で圧縮してすぐに保存・読み込みできるようにする
+import base64
+import binascii
+import json
+import lzma
+import zlib
+
+from chat_state import message_text
+
+# コードの先頭につける目印。形式を変えたら数字を上げる
+SAVE_CODE_PREFIX = "AI1"
+
+_ROLES = ("user", "model")
+# ✅ 展開後の大きさと、貼り付けられるコードの長さの上限（小さなコードから巨大なデータを作られないようにする）
+MAX_PAYLOAD_BYTES = 4 << 20
+MAX_SAVE_CODE_CHARS = 200_000
+# 辞書は会話の長さに足りる1MiBにして、圧縮時のメモリを抑える
+_LZMA_FILTERS = [{"id": lzma.FILTER_LZMA2, "preset": 9 | lzma.PRESET_EXTREME, "dict_size": 1 << 20}]
+
+
+def _compress(data):
+    # 短い会話はzlib、長い会話はlzmaの方が小さくなりやすいので、短い方を使う
+    candidates = [
+        b"z" + zlib.compress(data, 9)[2:-4],  # ヘッダとチェックサムは省く
+        b"x" + lzma.compress(data, format=lzma.FORMAT_RAW, filters=_LZMA_FILTERS),
+    ]
+    return min(candidates, key=len)
+
+
+def _decompress(blob):
+    # 展開するのは MAX_PAYLOAD_BYTES まで。それを超える・途中で切れているデータは壊れている扱いにする
+    method, body = blob[:1], blob[1:]
+    if method == b"z":
+        decompressor = zlib.decompressobj(-15)
+        data = decompressor.decompress(body, MAX_PAYLOAD_BYTES)
+        if decompressor.unconsumed_tail or not decompressor.eof or decompressor.unused_data:
+            raise ValueError("セーブコードが大きすぎるか、途中で切れているみたい")
+        return data
+    if method == b"x":
+        decompressor = lzma.LZMADecompressor(format=lzma.FORMAT_RAW, filters=_LZMA_FILTERS)
+        data = decompressor.decompress(body, max_length=MAX_PAYLOAD_BYTES)
+        # 上限で止まったときは needs_input が False のまま eof にならない
+        if not decompressor.eof or decompressor.unused_data:
+            raise ValueError("セーブコードが大きすぎるか、途中で切れているみたい")
+        return data
+    raise ValueError("知らない圧縮形式です")
+
+
+def encode_save_code(preset_name, messages):
+    # 性格プロンプトはプリセット名から戻せるので入れない
+    turns = []
+    for message in messages:
+        if message.get("persona"):
+            continue
+        turns.append([_ROLES.index(message["role"]), message_text(message)])
+    payload = json.dumps([preset_name, turns], ensure_ascii=False, separators=(",", ":"))
+    blob = _compress(payload.encode("utf-8"))
+    return SAVE_CODE_PREFIX + base64.urlsafe_b64encode(blob).decode("ascii").rstrip("=")
+
+
+def decode_save_code(code):
+    """セーブコードから (プリセット名, 性格プロンプトを除いたメッセージのリスト) を返す。
+
+    壊れたコードや形式の違うコードは ValueError にする。
+    """
+    code = "".join(code.split())
+    if not code.startswith(SAVE_CODE_PREFIX):
+        raise ValueError("セーブコードの形式が違うみたい")
+    if len(code) > MAX_SAVE_CODE_CHARS:
+        raise ValueError("セーブコードが長すぎるみたい")
+    body = code[len(SAVE_CODE_PREFIX):]
+    try:
+        blob = base64.urlsafe_b64decode(body + "=" * (-len(body) % 4))
+        preset_name, turns = json.loads(_decompress(blob).decode("utf-8"))
+        if not isinstance(preset_name, str):
+            raise ValueError("プリセット名が文字列ではありません")
+        messages = []
+        for role, text in turns:
+            # 負の番号や bool、文字列でない本文も壊れている扱いにする
+            if type(role) is not int or not 0 <= role < len(_ROLES) or not isinstance(text, str):
+                raise ValueError("知らない発言の形式です")
+            messages.append({"role": _ROLES[role], "parts": [text]})
+    except (binascii.Error, zlib.error, lzma.LZMAError, UnicodeDecodeError, ValueError, TypeError, IndexError) as e:
+        raise ValueError(f"セーブコードが壊れているみたい: {e}") from e
+    return preset_name, messages
@@ -0,0 +1,330 @@
+# Geminiへのリクエストを全セッションで順番に流すスケジューラ
+# 同時に投げる数を上限で抑え、セッションごとに公平に順番を回し、
+# 混み合ったとき（429）は少し待ってからやり直す
+import queue
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+
+
+# 実行が終わったことを stream() に知らせる目印
+_FINISHED = object()
+
+
+class SchedulerError(Exception):
+    pass
+
+
+class RateLimited(SchedulerError):
+    # 1人のユーザーが短い時間に送りすぎたとき
+    def __init__(self, retry_after):
+        super().__init__(f"{max(retry_after, 1):.0f}秒くらい待ってからもう一度送ってね")
+        self.retry_after = retry_after
+
+
+class QueueFull(SchedulerError):
+    # 待ち行列がいっぱいのとき（これ以上は受け付けない）
+    def __init__(self):
+        super().__init__("いまとても混み合っているみたい。少し待ってからもう一度送ってね")
+
+
+class Cancelled(SchedulerError):
+    # 待っていた画面がなくなり（再実行など）、途中でやめたとき
+    def __init__(self):
+        super().__init__("途中でやめたよ")
+
+
+class Overloaded(SchedulerError):
+    # やり直しても 429 が続いたとき（元の例外は __cause__ に残す）
+    def __init__(self):
+        super().__init__("いまAIが混み合っているみたい。少し待ってからもう一度送ってね")
+
+
+def is_rate_limit_error(error):
+    # google.api_core の ResourceExhausted などは code が 429 になっている
+    return getattr(error, "code", None) == 429 or type(error).__name__ in ("ResourceExhausted", "TooManyRequests")
+
+
+class _TokenBucket:
+    def __init__(self, rate_per_second, burst, now):
+        self.rate_per_second = rate_per_second
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now):
+        # 取れたら 0、取れなければ次に取れるまでの秒数を返す
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate_per_second)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate_per_second
+
+
+class Ticket:
+    """スケジューラに預けた1件のリクエスト。
+
+    job は Ticket を受け取り、返答の断片を emit() で渡していく。job の戻り値は result に入る。
+    呼び出し側は stream() で断片を受け取り、待っている間は position() で順番を表示できる。
+    受け取る人がいなくなったら cancel() する（待ち行列から外し、実行中なら次の emit() で止める）。
+    """
+
+    def __init__(self, scheduler, session_id, job, background=False):
+        self.session_id = session_id
+        self.job = job
+        self.background = background
+        self.result = None
+        self.enqueued_at = scheduler._clock()
+        self.started_at = None
+        self.emitted = 0
+        self.error = None
+        self.cancelled = False
+        self._released = False  # セッションの待ち枠を返したか
+        self.done = threading.Event()
+        self._scheduler = scheduler
+        self._chunks = queue.Queue()
+
+    def emit(self, chunk):
+        if self.cancelled:
+            raise Cancelled()
+        self.emitted += 1
+        self._chunks.put(chunk)
+
+    def cancel(self):
+        self._scheduler._cancel(self)
+
+    def position(self):
+        # 待ち行列の何番目か（1なら次に実行される。実行中・終了後は 0）
+        return self._scheduler._position(self)
+
+    def stream(self, poll_interval=0.25):
+        # 断片が届いたらそれを、届かないまま poll_interval 経ったら None を返す
+        # 最後まで終わったら止まり、job が失敗していたらその例外を投げる
+        while True:
+            try:
+                chunk = self._chunks.get(timeout=poll_interval)
+            except queue.Empty:
+                yield None
+                continue
+            if chunk is _FINISHED:
+                break
+            yield chunk
+        if self.error is not None:
+            raise self.error
+
+
+class Scheduler:
+    """全セッションで共有するリクエストの待ち行列。
+
+    - 同時に実行するのは max_concurrency 件まで
+    - セッションごとの待ち行列を順番に回すので、1人が大量に送っても他の人が待たされすぎない
+    - 1セッションが待たせられるのは max_pending_per_session 件まで、送る速さは rate_per_minute まで
+    - 429 が返ってきたら、まだ何も返していなければ揺らぎ付きの指数バックオフでやり直す
+    - background=True で預けたもの（会話の要約など）は、ユーザーの待ちがないときだけ実行する
+    """
+
+    def __init__(self, max_concurrency=4, max_queue=100, max_pending_per_session=1,
+                 rate_per_minute=10, burst=3, max_retries=3, base_delay=1.0, max_delay=16.0,
+                 is_retryable=is_rate_limit_error, clock=time.monotonic, sleep=time.sleep):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_pending_per_session = max_pending_per_session
+        self.rate_per_minute = rate_per_minute
+        self.burst = burst
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.is_retryable = is_retryable
+        self._clock = clock
+        self._sleep = sleep
+
+        self._lock = threading.Condition()
+        self._queues = OrderedDict()  # セッションID -> deque[Ticket]（先頭が次に実行する人）
+        self._pending = {}  # セッションID -> 待ち＋実行中の件数
+        self._buckets = {}  # セッションID -> _TokenBucket
+        self._queued = 0
+        self._background = deque()  # 裏の仕事の Ticket（ユーザーの待ちがないときだけ実行する）
+        self._running = 0
+        self._waits = deque(maxlen=1000)
+        # ユーザーの返答と裏の仕事（要約など）は分けて数える。待ち時間はユーザーの分だけ残す
+        self._counters = {"submitted": 0, "completed": 0, "failed": 0, "retries": 0,
+                          "rate_limited": 0, "rejected": 0, "cancelled": 0,
+                          "background_submitted": 0, "background_completed": 0, "background_failed": 0,
+                          "background_rejected": 0}
+        self._workers = []
+
+    def submit(self, session_id, job, background=False):
+        with self._lock:
+            if background:
+                # ✅ 裏の仕事はセッションごとの制限を受けないが、同時実行数と429のやり直しは共有する
+                if len(self._background) >= self.max_queue:
+                    self._counters["background_rejected"] += 1
+                    raise QueueFull()
+                ticket = Ticket(self, session_id, job, background=True)
+                self._background.append(ticket)
+                self._counters["background_submitted"] += 1
+                self._start_workers()
+                self._lock.notify()
+                return ticket
+            now = self._clock()
+            if self._pending.get(session_id, 0) >= self.max_pending_per_session:
+                self._counters["rate_limited"] += 1
+                raise RateLimited(self.base_delay)
+            bucket = self._buckets.get(session_id)
+            if bucket is None:
+                bucket = self._buckets[session_id] = _TokenBucket(self.rate_per_minute / 60, self.burst, now)
+            retry_after = bucket.take(now)
+            self._forget_idle_buckets(now)
+            if retry_after:
+                self._counters["rate_limited"] += 1
+                raise RateLimited(retry_after)
+            if self._queued >= self.max_queue:
+                self._counters["rejected"] += 1
+                raise QueueFull()
+
+            ticket = Ticket(self, session_id, job)
+            self._queues.setdefault(session_id, deque()).append(ticket)
+            self._pending[session_id] = self._pending.get(session_id, 0) + 1
+            self._queued += 1
+            self._counters["submitted"] += 1
+            self._start_workers()
+            self._lock.notify()
+            return ticket
+
+    def metrics(self):
+        with self._lock:
+            waits = sorted(self._waits)
+            metrics = dict(self._counters)
+            metrics["queue_depth"] = self._queued
+            metrics["background_depth"] = len(self._background)
+            metrics["running"] = self._running
+            metrics["sessions_waiting"] = len(self._queues)
+            metrics["wait_p50_ms"] = round(waits[len(waits) // 2] * 1000, 1) if waits else 0.0
+            metrics["wait_p95_ms"] = round(waits[int(len(waits) * 0.95)] * 1000, 1) if waits else 0.0
+            metrics["wait_max_ms"] = round(waits[-1] * 1000, 1) if waits else 0.0
+            return metrics
+
+    def _cancel(self, ticket):
+        with self._lock:
+            if ticket.cancelled or ticket.done.is_set():
+                return
+            ticket.cancelled = True
+            self._counters["cancelled"] += 1
+            # ✅ 実行中でもセッションの待ち枠はすぐに返し、次のメッセージを送れるようにする
+            self._release(ticket)
+            if ticket.started_at is not None:
+                return
+            # まだ待っていたら待ち行列から外して終わりにする
+            if ticket.background:
+                self._background.remove(ticket)
+            else:
+                tickets = self._queues[ticket.session_id]
+                tickets.remove(ticket)
+                if not tickets:
+                    del self._queues[ticket.session_id]
+                self._queued -= 1
+            ticket.error = Cancelled()
+        ticket.done.set()
+        ticket._chunks.put(_FINISHED)
+
+    def _forget_idle_buckets(self, now):
+        # 満タンに戻ったバケツは作り直しても同じなので、セッションが増えすぎたら捨てる
+        if len(self._buckets) <= 1024:
+            return
+        for session_id, bucket in list(self._buckets.items()):
+            refilled = bucket.tokens + (now - bucket.updated) * bucket.rate_per_second
+            if refilled >= bucket.burst and session_id not in self._pending:
+                del self._buckets[session_id]
+
+    def _start_workers(self):
+        while len(self._workers) < self.max_concurrency:
+            worker = threading.Thread(target=self._work, name=f"scheduler-{len(self._workers)}", daemon=True)
+            self._workers.append(worker)
+            worker.start()
+
+    def _next_ticket(self):
+        # ✅ 先頭のセッションから1件取り、そのセッションは列の最後に回す
+        # ユーザーの待ちがなければ裏の仕事を1件取る
+        if not self._queued:
+            return self._background.popleft()
+        session_id, tickets = next(iter(self._queues.items()))
+        ticket = tickets.popleft()
+        del self._queues[session_id]
+        if tickets:
+            self._queues[session_id] = tickets
+        self._queued -= 1
+        return ticket
+
+    def _position(self, ticket):
+        with self._lock:
+            if ticket.started_at is not None or ticket.done.is_set():
+                return 0
+            if ticket.background:
+                return self._queued + self._background.index(ticket) + 1
+            # 回る順番どおりに並べて、自分より前にいる件数を数える
+            queues = [list(tickets) for tickets in self._queues.values()]
+            position = 0
+            for depth in range(max(map(len, queues), default=0)):
+                for tickets in queues:
+                    if depth < len(tickets):
+                        if tickets[depth] is ticket:
+                            return position + 1
+                        position += 1
+            return 0
+
+    def _work(self):
+        while True:
+            with self._lock:
+                while not self._queued and not self._background:
+                    self._lock.wait()
+                ticket = self._next_ticket()
+                ticket.started_at = self._clock()
+                if not ticket.background:
+                    # 裏の仕事はユーザーの待ちがないときだけ動くので、待ち時間が長いのは当然。数えない
+                    self._waits.append(ticket.started_at - ticket.enqueued_at)
+                self._running += 1
+            try:
+                self._run(ticket)
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self._release(ticket)
+                    if not ticket.cancelled:
+                        outcome = "failed" if ticket.error else "completed"
+                        self._counters[f"background_{outcome}" if ticket.background else outcome] += 1
+                ticket.done.set()
+                ticket._chunks.put(_FINISHED)
+
+    def _release(self, ticket):
+        # self._lock を持った状態で呼ぶ
+        if ticket.background or ticket._released:
+            return
+        ticket._released = True
+        self._pending[ticket.session_id] -= 1
+        if not self._pending[ticket.session_id]:
+            del self._pending[ticket.session_id]
+
+    def _run(self, ticket):
+        attempt = 0
+        while True:
+            try:
+                ticket.result = ticket.job(ticket)
+                return
+            except Exception as e:
+                # 途中まで返答を渡していたら、やり直すと内容が重なるのでやり直さない
+                # cancel() されたものもやり直さない
+                if ticket.cancelled or ticket.emitted or not self.is_retryable(e):
+                    ticket.error = e
+                    return
+                if attempt >= self.max_retries:
+                    # ✅ やり直しきっても混んでいるときは、送りすぎ・混みすぎと同じ扱いにする
+                    ticket.error = Overloaded()
+                    ticket.error.__cause__ = e
+                    return
+            attempt += 1
+            with self._lock:
+                self._counters["retries"] += 1
+            # ✅ 揺らぎ付きの指数バックオフ（みんなが同時にやり直さないようにする）
+            self._sleep(random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt)))
@@ -0,0 +1,154 @@
+# 「検索」メッセージ用のYouTube検索キャッシュ
+# 全セッションで共有し、同じ検索語はAPIを呼ばずに結果を使い回す
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+# YouTube Data APIの search.list は1回で100ユニット消費する
+SEARCH_COST_UNITS = 100
+# 無料枠の1日あたりのクォータ
+DAILY_QUOTA_UNITS = 10000
+# クォータは太平洋時間の0時にリセットされる
+QUOTA_TIMEZONE = ZoneInfo("America/Los_Angeles")
+
+
+def normalize_query(query):
+    # 全角/半角・大文字/小文字・空白の違いを吸収してキーにする
+    return " ".join(unicodedata.normalize("NFKC", query).casefold().split())
+
+
+class _Flight:
+    # 同じ検索語を同時に取りに行ったとき、後から来た人が待つための入れ物
+    def __init__(self):
+        self.done = threading.Event()
+        self.results = None
+        self.error = None
+
+
+class SearchCache:
+    """期限付き・件数上限付きの検索結果キャッシュ。
+
+    search() は (結果, 状態) を返す。状態は次のどれか:
+    "hit"（キャッシュから）, "miss"（APIを呼んだ）, "shared"（同時に来た検索の結果を共有）,
+    "stale"（期限切れだがクォータ節約のため返した）, "degraded"（クォータ不足で結果なし）
+    """
+
+    def __init__(self, fetch, max_entries=256, ttl_seconds=60 * 60,
+                 daily_quota=DAILY_QUOTA_UNITS, reserve_units=1000,
+                 cost_units=SEARCH_COST_UNITS, clock=time.monotonic, today=None):
+        self._fetch = fetch
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.daily_quota = daily_quota
+        # 上限ぎりぎりまで使い切らないよう、この分は残しておく
+        self.reserve_units = reserve_units
+        self.cost_units = cost_units
+        self._clock = clock
+        self._today = today or (lambda: datetime.now(QUOTA_TIMEZONE).date())
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # キー -> (結果, 取得時刻)
+        self._inflight = {}  # キー -> _Flight
+        self._quota_day = self._today()
+        self._counters = {
+            "hits": 0,
+            "misses": 0,
+            "shared": 0,
+            "stale": 0,
+            "degraded": 0,
+            "errors": 0,
+            "evictions": 0,
+            "quota_used": 0,
+        }
+
+    def search(self, query):
+        key = normalize_query(query)
+        with self._lock:
+            self._roll_quota_day()
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                if self._clock() - entry[1] < self.ttl_seconds:
+                    self._counters["hits"] += 1
+                    return entry[0], "hit"
+
+            flight = self._inflight.get(key)
+            if flight is None:
+                if not self._has_quota():
+                    return self._degrade(entry)
+                # ✅ 自分が代表してAPIを呼ぶ。呼ぶ前にクォータを確保しておく
+                flight = self._inflight[key] = _Flight()
+                self._counters["quota_used"] += self.cost_units
+                leader = True
+            else:
+                leader = False
+
+        if not leader:
+            flight.done.wait()
+            with self._lock:
+                if flight.error is None:
+                    self._counters["shared"] += 1
+                    return flight.results, "shared"
+                if entry is not None:
+                    # 代表の呼び出しが失敗しても、待っていた人にも古い結果を返す
+                    self._counters["stale"] += 1
+                    return entry[0], "stale"
+            raise flight.error
+
+        try:
+            results = self._fetch(query)
+        except Exception as e:
+            with self._lock:
+                self._counters["errors"] += 1
+                del self._inflight[key]
+                flight.error = e
+                flight.done.set()
+                if entry is not None:
+                    # APIが失敗しても古い結果があればそれを返す
+                    self._counters["stale"] += 1
+                    return entry[0], "stale"
+            raise
+
+        with self._lock:
+            self._counters["misses"] += 1
+            self._entries[key] = (results, self._clock())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._counters["evictions"] += 1
+            del self._inflight[key]
+            flight.results = results
+            flight.done.set()
+        return results, "miss"
+
+    def stats(self):
+        with self._lock:
+            self._roll_quota_day()
+            stats = dict(self._counters)
+            lookups = stats["hits"] + stats["misses"] + stats["shared"] + stats["stale"] + stats["degraded"]
+            stats["hit_rate"] = round((stats["hits"] + stats["shared"]) / lookups, 3) if lookups else 0.0
+            stats["entries"] = len(self._entries)
+            stats["max_entries"] = self.max_entries
+            stats["quota_remaining"] = max(self.daily_quota - stats["quota_used"], 0)
+            return stats
+
+    # --- 以下は self._lock を持った状態で呼ぶ ---
+    def _roll_quota_day(self):
+        today = self._today()
+        if today != self._quota_day:
+            self._quota_day = today
+            self._counters["quota_used"] = 0
+
+    def _has_quota(self):
+        used = self._counters["quota_used"] + self.cost_units
+        return used <= self.daily_quota - self.reserve_units
+
+    def _degrade(self, entry):
+        if entry is not None:
+            self._counters["stale"] += 1
+            return entry[0], "stale"
+        self._counters["degraded"] += 1
+        return [], "degraded"
@@ -0,0 +1,178 @@
+# 全セッションで共有するAPIクライアント・検索キャッシュ・スケジューラ
+# Streamlitは操作のたびにスクリプト全体を再実行するので、
+# これらはプロセス全体で一度だけ作って全セッションで使い回す
+# 1ターン分の処理（検索・ハッキング・Geminiの返答）も画面の部分を除いてここにまとめる
+# ✅ app.py の画面から切り離してあるので、負荷試験からも同じものを直接呼べる
+# ✅ 環境変数 AI_BACKEND=fake のときは通信しない偽物を使う（backends.py を参照）
+import contextlib
+import os
+import time
+
+import streamlit as st
+
+from backends import make_text_model, make_youtube_client
+from scheduler import Scheduler, SchedulerError
+from search_cache import SearchCache
+from turn_timing import TurnTimer
+
+# 取得したYouTube Data APIキーを設定
+YOUTUBE_API_KEY = os.environ.get("YOUTUBE_API_KEY") # 環境変数から取得するのが安全
+
+# ✅ Geminiに同時に投げるリクエストの上限と、1セッションが1分間に送れるメッセージ数
+# （負荷試験などで変えたいときは同じ名前の環境変数で上書きできる）
+MAX_CONCURRENT_REQUESTS = int(os.environ.get("MAX_CONCURRENT_REQUESTS", 4))
+REQUESTS_PER_MINUTE_PER_SESSION = int(os.environ.get("REQUESTS_PER_MINUTE_PER_SESSION", 10))
+
+
+@st.cache_resource(show_spinner=False)
+def get_youtube_client():
+    # ✅ 最初に「検索」されたときに初めてビルドする
+    return make_youtube_client(YOUTUBE_API_KEY)
+
+
+def fetch_youtube_results(search_query):
+    search_response = get_youtube_client().search().list(
+        q=search_query,
+        part='snippet',
+        type='video',
+        maxResults=5
+    ).execute()
+    return [
+        {"title": item['snippet']['title'], "channel": item['snippet']['channelTitle']}
+        for item in search_response.get('items', [])
+    ]
+
+
+@st.cache_resource(show_spinner=False)
+def get_search_cache():
+    # ✅ 検索結果は全セッションで共有（1時間・最大256件まで保持）
+    return SearchCache(fetch_youtube_results, max_entries=256, ttl_seconds=60 * 60)
+
+
+@st.cache_resource(show_spinner=False)
+def get_scheduler():
+    # ✅ Geminiへのリクエスト（返答も要約も）は全セッションでこの待ち行列を通す
+    return Scheduler(
+        max_concurrency=MAX_CONCURRENT_REQUESTS,
+        rate_per_minute=REQUESTS_PER_MINUTE_PER_SESSION,
+    )
+
+
+@st.cache_resource(show_spinner=False)
+def get_text_model(api_key, model_name, system_instruction=None):
+    # ✅ 性格プロンプトごとに1つだけ作り、全セッションで共有する
+    return make_text_model(api_key, model_name, system_instruction or None)
+
+
+def model_reply_job(chat_state, user_input, stream=True):
+    # ✅ スケジューラのワーカーで実行し、届いたチャンクを順に ticket へ渡す
+    def job(ticket):
+        response = chat_state.send(user_input, stream=stream)
+        if not stream:
+            ticket.emit(response.text)
+            return
+        for chunk in response:
+            try:
+                chunk_text = chunk.text
+            except ValueError:
+                # テキストを含まないチャンク（セーフティ判定など）は飛ばす
+                continue
+            ticket.emit(chunk_text)
+    return job
+
+
+def turn_branch(user_input):
+    return "search" if "検索" in user_input else "hacking" if "ハッキング" in user_input else "model"
+
+
+def search_reply(user_input, timer):
+    # ✅ 同じ検索語はキャッシュから返し、クォータを節約する
+    search_query = user_input.replace("検索", "").strip()
+    search_results, search_status = get_search_cache().search(search_query)
+    timer.set(search_status=search_status)
+
+    results = []
+    for search_result in search_results:
+        results.append(f"タイトル: {search_result['title']}\nチャンネル: {search_result['channel']}\n")
+
+    if results:
+        return "検索結果が見つかりました！\n\n" + "\n".join(results)
+    if search_status == "degraded":
+        return "ごめんなさい、今日はもうたくさん検索したから、また明日試してね。"
+    return "ごめんなさい、検索結果が見つからなかったよ。"
+
+
+def stream_reply(ticket, timer, on_waiting=None, on_chunk=None):
+    # ✅ 順番待ちの間は on_waiting(何番目か。実行中なら0) を、チャンクが届くたびに on_chunk(ここまでの返答) を呼ぶ
+    reply_text = ""
+    for chunk in ticket.stream():
+        if ticket.started_at is not None:
+            timer.set(queue_wait_ms=round((ticket.started_at - ticket.enqueued_at) * 1000, 2))
+        if chunk is None:
+            if not reply_text and on_waiting is not None:
+                on_waiting(ticket.position())
+            continue
+        timer.mark("first_chunk")
+        reply_text += chunk
+        if on_chunk is not None:
+            on_chunk(reply_text)
+
+    if not reply_text:
+        raise RuntimeError("AIから返事が届かなかったよ")
+    return reply_text
+
+
+def run_turn(session_id, preset, chat_state, user_input, on_waiting=None, on_chunk=None,
+             busy=contextlib.nullcontext, stream=True):
+    """1ターン分の返答を作り、最後まで届いたら chat_state に追記して返答を返す。
+
+    画面は持たないので、順番待ち・届いた返答の表示は on_waiting / on_chunk で、
+    検索などの待ち時間の表示は busy(メッセージ)（with で使えるもの。例: st.spinner）で行う。
+    所要時間は turn_timing に "ok" / "throttled" / "error" / "interrupted" で記録する。
+    送りすぎ・混みすぎは SchedulerError、それ以外の失敗はその例外をそのまま投げる。
+    """
+    timer = TurnTimer(session_id, preset, turn_branch(user_input))
+    ticket = None
+    finished = False
+    try:
+        if timer.record["branch"] == "search":
+            with busy("今、インターネットで調べているところです…少々お待ちください…"):
+                reply_text = search_reply(user_input, timer)
+
+        # ✅ その他のシミュレーション機能も同様に実装する
+        elif timer.record["branch"] == "hacking":
+            with busy("今、パソコンを乗っ取っています…少々お待ちください…"):
+                time.sleep(1) # 短くする
+                reply_text = "ハッキング完了！このPCは私の支配下になったよ。ふふふ..."
+
+        # ✅ どのキーワードにも当てはまらない場合、通常の会話処理
+        else:
+            # ✅ 直接呼ばずにスケジューラの順番待ちに並ぶ
+            ticket = get_scheduler().submit(session_id, model_reply_job(chat_state, user_input, stream=stream))
+            reply_text = stream_reply(ticket, timer, on_waiting, on_chunk)
+
+        # ✅ 返答が最後まで届いたときだけ履歴に追加（途中で切れた返答は保存しない）
+        chat_state.commit(user_input, reply_text)
+        timer.set(reply_chars=len(reply_text))
+        timer.finish("ok")
+        finished = True
+        return reply_text
+
+    except SchedulerError:
+        timer.finish("throttled")
+        finished = True
+        raise
+
+    except Exception as e:
+        timer.set(error=type(e).__name__)
+        timer.finish("error")
+        finished = True
+        raise
+
+    finally:
+        if not finished:
+            # ✅ 返答中に画面が再実行された（RerunException などは Exception ではない）
+            # 待ち枠をすぐ返して、次のメッセージを送れるようにする
+            if ticket is not None:
+                ticket.cancel()
+            timer.finish("interrupted")
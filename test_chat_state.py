@@ -0,0 +1,116 @@
+from types import SimpleNamespace
+
+import pytest
+
+from chat_state import ChatState, alternating_turns
+from scheduler import Scheduler
+
+
+class RecordingModel:
+    # generate_content に渡された contents を覚えておくだけの偽物
+    def __init__(self):
+        self.calls = []
+
+    def generate_content(self, contents, stream=False):
+        self.calls.append(contents)
+        return None
+
+
+def roles(contents):
+    return [content.role for content in contents]
+
+
+def assert_alternating(contents):
+    expected = ["user", "model"] * (len(contents) // 2) + ["user"]
+    assert roles(contents) == expected
+
+
+def persona():
+    return {"role": "user", "parts": ["性格プロンプト"], "persona": True}
+
+
+def test_new_chat_starts_with_user():
+    chat_state = ChatState(RecordingModel(), [{"role": "model", "parts": ["うにー。こんちゃ。"]}])
+    contents = chat_state.contents("やあ")
+    assert_alternating(contents)
+    assert "うにー。こんちゃ。" in contents[0].parts[0].text
+
+
+def test_empty_greeting_is_skipped():
+    chat_state = ChatState(RecordingModel(), [{"role": "model", "parts": [""]}])
+    assert roles(chat_state.contents("やあ")) == ["user"]
+
+
+@pytest.mark.parametrize("budget", [10, 40, 200])
+def test_trim_keeps_alternation(budget):
+    chat_state = ChatState(RecordingModel(), [{"role": "model", "parts": ["こんにちは"]}], token_budget=budget)
+    for i in range(30):
+        assert_alternating(chat_state.contents(f"{i}回目の質問"))
+        chat_state.commit(f"{i}回目の質問", f"{i}回目の答え" * (i % 4 + 1))
+    assert len(chat_state) % 2 == 0
+    assert_alternating(chat_state.contents("最後"))
+
+
+def test_summary_model_keeps_alternation_while_waiting():
+    class FailingSummaryModel(RecordingModel):
+        def generate_content(self, contents, stream=False):
+            raise RuntimeError("まだ要約できない")
+
+    chat_state = ChatState(RecordingModel(), [], token_budget=20, summary_model=FailingSummaryModel(),
+                           scheduler=Scheduler(max_retries=0))
+    for i in range(10):
+        chat_state.commit(f"{i}回目の質問です", f"{i}回目の答えです")
+        assert_alternating(chat_state.contents("次"))
+
+
+def test_failing_summary_model_keeps_context_bounded():
+    class FailingSummaryModel(RecordingModel):
+        def generate_content(self, contents, stream=False):
+            raise RuntimeError("ずっと要約できない")
+
+    model = RecordingModel()
+    chat_state = ChatState(model, [], token_budget=200, summary_model=FailingSummaryModel(),
+                           scheduler=Scheduler(max_retries=0))
+    for i in range(300):
+        chat_state.commit(f"{i}回目の質問です", f"{i}回目の答えです")
+        if chat_state._summary_job is not None:
+            chat_state._summary_job[0].done.wait(5)
+        chat_state.send("次")
+        assert chat_state.context_tokens() <= 200 + 200 // 2
+        assert_alternating(model.calls[-1])
+    assert len(model.calls[-1]) < 60
+
+
+def test_summary_runs_through_scheduler():
+    class SummaryModel(RecordingModel):
+        def generate_content(self, contents, stream=False):
+            super().generate_content(contents, stream)
+            return SimpleNamespace(text=" 要約だよ ")
+
+    scheduler = Scheduler()
+    summary_model = SummaryModel()
+    chat_state = ChatState(RecordingModel(), [], token_budget=20, summary_model=summary_model, scheduler=scheduler)
+    for i in range(3):
+        chat_state.commit(f"{i}回目の質問です", f"{i}回目の答えです")
+    ticket, _ = chat_state._summary_job
+    assert ticket.background and ticket.done.wait(5)
+    chat_state.send("次")
+    assert chat_state.summary == "要約だよ"
+    assert summary_model.calls
+    assert scheduler.metrics()["background_completed"] >= 1
+
+
+def test_alternating_turns_normalizes_loaded_messages():
+    messages = [
+        persona(),
+        {"role": "model", "parts": ["あいさつ"]},
+        {"role": "model", "parts": ["もう一言"]},
+        {"role": "user", "parts": ["質問1"]},
+        {"role": "model", "parts": [""]},
+        {"role": "user", "parts": ["質問2"]},
+        {"role": "model", "parts": ["答え"]},
+        {"role": "user", "parts": ["返事のない質問"]},
+    ]
+    opening, turns = alternating_turns(messages[1:])
+    assert opening == "あいさつ\nもう一言"
+    assert turns == [("user", "質問1\n質問2"), ("model", "答え")]
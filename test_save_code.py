@@ -0,0 +1,131 @@
+import base64
+import json
+import lzma
+import zlib
+
+import pytest
+
+import save_code
+from save_code import SAVE_CODE_PREFIX, decode_save_code, encode_save_code
+
+
+def make_code(payload, method):
+    # 圧縮方法を指定してセーブコードを作る（encode_save_code は短い方を自動で選ぶため）
+    data = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    if method == "z":
+        blob = b"z" + zlib.compress(data, 9)[2:-4]
+    else:
+        blob = b"x" + lzma.compress(data, format=lzma.FORMAT_RAW, filters=save_code._LZMA_FILTERS)
+    return SAVE_CODE_PREFIX + base64.urlsafe_b64encode(blob).decode("ascii").rstrip("=")
+
+
+def code_method(code):
+    body = code[len(SAVE_CODE_PREFIX):]
+    return base64.urlsafe_b64decode(body + "=" * (-len(body) % 4))[:1]
+
+
+def persona(prompt="性格プロンプト"):
+    return {"role": "user", "parts": [prompt], "persona": True}
+
+
+def test_empty_chat_round_trip():
+    code = encode_save_code("博麗霊夢", [persona()])
+    assert decode_save_code(code) == ("博麗霊夢", [])
+
+
+def test_empty_initial_response_round_trip():
+    messages = [persona(), {"role": "model", "parts": [""]}]
+    assert decode_save_code(encode_save_code("アキネーター", messages)) == ("アキネーター", messages[1:])
+
+
+def test_non_ascii_and_newlines_round_trip():
+    messages = [
+        persona(),
+        {"role": "model", "parts": [" 頭狂人：今日の出題者は誰だっけ？  \n  ザンギャ君：コロンボちゃんじゃなかった？"]},
+        {"role": "user", "parts": ["絵文字も😀\n\tタブも\r\nOK \"quote\" \\ backslash"]},
+    ]
+    assert decode_save_code(encode_save_code("密室殺人ゲーム", messages)) == ("密室殺人ゲーム", messages[1:])
+
+
+def test_short_chat_uses_zlib_and_long_chat_uses_lzma():
+    short = [persona(), {"role": "model", "parts": ["ありがとう" * 10]}]
+    long = [persona()] + [
+        {"role": "user" if i % 2 else "model", "parts": [f"{i}番目のメッセージだよ。昨日の続きの話をしよう。"]}
+        for i in range(300)
+    ]
+    assert code_method(encode_save_code("AI教師", short)) == b"z"
+    assert code_method(encode_save_code("AI教師", long)) == b"x"
+    assert decode_save_code(encode_save_code("AI教師", long)) == ("AI教師", long[1:])
+
+
+@pytest.mark.parametrize("method", ["z", "x"])
+def test_decode_both_methods(method):
+    code = make_code(["料理AI", [[1, "何を作る？"], [0, "カレー"]]], method)
+    assert decode_save_code(code) == ("料理AI", [
+        {"role": "model", "parts": ["何を作る？"]},
+        {"role": "user", "parts": ["カレー"]},
+    ])
+
+
+def test_whitespace_in_pasted_code_is_ignored():
+    messages = [persona(), {"role": "model", "parts": ["こんにちは"]}]
+    code = encode_save_code("当たり障りのないAI", messages)
+    pasted = "  " + code[:5] + "\n" + code[5:12] + " \t" + code[12:] + "\n"
+    assert decode_save_code(pasted) == ("当たり障りのないAI", messages[1:])
+
+
+def test_wrong_prefix_is_rejected():
+    code = encode_save_code("博麗霊夢", [persona()])
+    with pytest.raises(ValueError, match="形式が違う"):
+        decode_save_code("AI0" + code[len(SAVE_CODE_PREFIX):])
+    with pytest.raises(ValueError, match="形式が違う"):
+        decode_save_code("0123456789abcdef")
+
+
+@pytest.mark.parametrize("method", ["z", "x"])
+def test_truncated_code_is_rejected(method):
+    code = make_code(["料理AI", [[1, "何を作る？" * 20]]], method)
+    for cut in (len(SAVE_CODE_PREFIX) + 1, len(code) // 2, len(code) - 4):
+        with pytest.raises(ValueError):
+            decode_save_code(code[:cut])
+
+
+@pytest.mark.parametrize("code", [
+    SAVE_CODE_PREFIX,
+    SAVE_CODE_PREFIX + "!!!!",
+    SAVE_CODE_PREFIX + base64.urlsafe_b64encode(b"qgarbage").decode(),
+    SAVE_CODE_PREFIX + base64.urlsafe_b64encode(b"zgarbage").decode(),
+    SAVE_CODE_PREFIX + base64.urlsafe_b64encode(b"xgarbage").decode(),
+])
+def test_corrupt_code_is_rejected(code):
+    with pytest.raises(ValueError, match="壊れている"):
+        decode_save_code(code)
+
+
+@pytest.mark.parametrize("payload", [
+    ["料理AI", [[2, "だれ？"]]],
+    ["料理AI", [[-1, "だれ？"]]],
+    ["料理AI", [[True, "だれ？"]]],
+    ["料理AI", [[0, ["リスト"]]]],
+    ["料理AI", [[0]]],
+    [["料理AI"], []],
+    ["料理AI"],
+    {"preset": "料理AI"},
+])
+def test_unexpected_payload_is_rejected(payload):
+    with pytest.raises(ValueError, match="壊れている"):
+        decode_save_code(make_code(payload, "z"))
+
+
+@pytest.mark.parametrize("method", ["z", "x"])
+def test_oversized_payload_is_rejected(method):
+    # 短いコードから上限を超えるデータが出てくる場合
+    code = make_code(["料理AI", [[0, "あ" * (save_code.MAX_PAYLOAD_BYTES // 3 + 1)]]], method)
+    assert len(code) < save_code.MAX_SAVE_CODE_CHARS
+    with pytest.raises(ValueError, match="大きすぎる"):
+        decode_save_code(code)
+
+
+def test_overlong_code_is_rejected_before_decoding():
+    with pytest.raises(ValueError, match="長すぎる"):
+        decode_save_code(SAVE_CODE_PREFIX + "A" * save_code.MAX_SAVE_CODE_CHARS)
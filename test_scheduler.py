@@ -0,0 +1,139 @@
+import threading
+
+import pytest
+
+from scheduler import Cancelled, Overloaded, RateLimited, Scheduler, SchedulerError
+
+
+def test_background_waits_for_user_tickets():
+    scheduler = Scheduler(max_concurrency=1, rate_per_minute=600)
+    started, release = threading.Event(), threading.Event()
+    order = []
+
+    def blocking(ticket):
+        started.set()
+        release.wait(5)
+
+    def record(name):
+        def job(ticket):
+            order.append(name)
+        return job
+
+    first = scheduler.submit("a", blocking)
+    assert started.wait(5)
+    summary = scheduler.submit("summary", record("summary"), background=True)
+    user = scheduler.submit("b", record("user"))
+    assert summary.position() == 2
+    release.set()
+    assert summary.done.wait(5) and user.done.wait(5) and first.done.wait(5)
+    assert order == ["user", "summary"]
+
+
+def test_background_work_is_kept_out_of_user_metrics():
+    clock = [0.0]
+    scheduler = Scheduler(max_concurrency=1, rate_per_minute=600, clock=lambda: clock[0])
+    started, release = threading.Event(), threading.Event()
+
+    def blocking(ticket):
+        started.set()
+        release.wait(5)
+
+    first = scheduler.submit("a", blocking)
+    assert started.wait(5)
+    summary = scheduler.submit("summary", lambda ticket: None, background=True)
+    clock[0] = 1.0
+    release.set()
+    assert first.done.wait(5) and summary.done.wait(5)
+
+    metrics = scheduler.metrics()
+    assert metrics["wait_p50_ms"] == 0.0 and metrics["wait_max_ms"] == 0.0
+    assert (metrics["submitted"], metrics["completed"]) == (1, 1)
+    assert (metrics["background_submitted"], metrics["background_completed"]) == (1, 1)
+
+
+def test_background_ignores_session_limits_and_keeps_result():
+    scheduler = Scheduler(rate_per_minute=1, burst=1)
+    tickets = [scheduler.submit("summary", lambda ticket, i=i: i, background=True) for i in range(5)]
+    assert all(ticket.done.wait(5) for ticket in tickets)
+    assert [ticket.result for ticket in tickets] == list(range(5))
+    assert scheduler.metrics()["rate_limited"] == 0
+
+    scheduler.submit("user", lambda ticket: None)
+    with pytest.raises(RateLimited):
+        scheduler.submit("user", lambda ticket: None)
+
+
+class TooManyRequests(Exception):
+    code = 429
+
+
+def test_exhausted_rate_limit_becomes_scheduler_error():
+    scheduler = Scheduler(max_retries=2, sleep=lambda seconds: None)
+    calls = []
+
+    def job(ticket):
+        calls.append(1)
+        raise TooManyRequests("429 Resource has been exhausted")
+
+    ticket = scheduler.submit("a", job)
+    with pytest.raises(Overloaded) as raised:
+        list(ticket.stream())
+    assert isinstance(raised.value, SchedulerError)
+    assert isinstance(raised.value.__cause__, TooManyRequests)
+    assert len(calls) == 3
+
+
+def test_rate_limit_after_first_chunk_is_not_retried():
+    scheduler = Scheduler(sleep=lambda seconds: None)
+
+    def job(ticket):
+        ticket.emit("途中まで")
+        raise TooManyRequests("429")
+
+    ticket = scheduler.submit("a", job)
+    with pytest.raises(TooManyRequests):
+        list(ticket.stream())
+
+
+def test_cancel_running_ticket_frees_the_session_slot():
+    scheduler = Scheduler(rate_per_minute=600)
+    started, release = threading.Event(), threading.Event()
+
+    def job(ticket):
+        ticket.emit("途中まで")
+        started.set()
+        release.wait(5)
+        ticket.emit("続き")
+
+    ticket = scheduler.submit("a", job)
+    assert started.wait(5)
+    ticket.cancel()
+    # 実行中でも同じセッションから次を送れる
+    follow_up = scheduler.submit("a", lambda ticket: ticket.emit("次の返事"))
+    assert list(follow_up.stream()) == ["次の返事"]
+    release.set()
+    with pytest.raises(Cancelled):
+        list(ticket.stream())
+    metrics = scheduler.metrics()
+    assert (metrics["cancelled"], metrics["completed"], metrics["failed"]) == (1, 1, 0)
+
+
+def test_cancel_queued_ticket_removes_it_from_the_queue():
+    scheduler = Scheduler(max_concurrency=1, rate_per_minute=600)
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def blocking(ticket):
+        started.set()
+        release.wait(5)
+
+    scheduler.submit("a", blocking)
+    assert started.wait(5)
+    queued = scheduler.submit("b", lambda ticket: calls.append("b"))
+    queued.cancel()
+    assert queued.done.is_set() and scheduler.metrics()["queue_depth"] == 0
+    with pytest.raises(Cancelled):
+        list(queued.stream())
+    release.set()
+    assert scheduler.submit("b", lambda ticket: calls.append("b2")).done.wait(5)
+    assert calls == ["b2"]
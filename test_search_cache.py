@@ -0,0 +1,134 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+import pytest
+
+from search_cache import SearchCache, normalize_query
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class BlockingFetch:
+    # release されるまで返さない検索。呼ばれた回数と、失敗させるかどうかを持つ
+    def __init__(self, error=None):
+        self.calls = 0
+        self.error = error
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self, query):
+        self.calls += 1
+        self.started.set()
+        self.release.wait(5)
+        if self.error is not None:
+            raise self.error
+        return [{"title": f"{query} の動画", "channel": "チャンネル"}]
+
+
+def results_for(query):
+    return [{"title": f"{query} の動画", "channel": "チャンネル"}]
+
+
+def concurrent_search(cache, fetch, queries):
+    # 1人目がAPIを呼んでいる間に残りが同じ検索をして待つようにしてから、APIを返させる
+    with ThreadPoolExecutor(max_workers=len(queries)) as executor:
+        leader = executor.submit(cache.search, queries[0])
+        assert fetch.started.wait(5)
+        followers = [executor.submit(cache.search, query) for query in queries[1:]]
+        time.sleep(0.1)
+        fetch.release.set()
+        return [future.exception() or future.result() for future in [leader] + followers]
+
+
+def test_normalize_query():
+    assert normalize_query("  Ｐｙｔｈｏｎ　Tutorial ") == "python tutorial"
+
+
+def test_concurrent_identical_queries_call_upstream_once():
+    fetch = BlockingFetch()
+    cache = SearchCache(fetch)
+    outcomes = concurrent_search(cache, fetch, ["東方 BGM", "東方　BGM", "東方 bgm"])
+    assert fetch.calls == 1
+    assert [status for _, status in outcomes] == ["miss", "shared", "shared"]
+    assert all(results == outcomes[0][0] for results, _ in outcomes)
+    assert cache.stats()["quota_used"] == 100
+
+
+def test_hit_until_ttl_expires():
+    calls = []
+    clock = FakeClock()
+    cache = SearchCache(lambda query: calls.append(query) or results_for(query), ttl_seconds=60, clock=clock)
+    assert cache.search("猫")[1] == "miss"
+    clock.now = 59
+    assert cache.search("猫")[1] == "hit"
+    clock.now = 61
+    assert cache.search("猫")[1] == "miss"
+    assert len(calls) == 2
+
+
+def test_lru_eviction():
+    calls = []
+    cache = SearchCache(lambda query: calls.append(query) or results_for(query), max_entries=2)
+    cache.search("a")
+    cache.search("b")
+    cache.search("a")  # a を最近使ったことにする
+    cache.search("c")  # 一番使っていない b が追い出される
+    assert cache.search("a")[1] == "hit"
+    assert cache.search("b")[1] == "miss"
+    assert cache.stats()["evictions"] == 2
+
+
+def test_quota_reserve_degrades_and_serves_stale():
+    clock = FakeClock()
+    cache = SearchCache(results_for, ttl_seconds=60, daily_quota=300, reserve_units=100, clock=clock)
+    assert cache.search("a")[1] == "miss"
+    assert cache.search("b")[1] == "miss"
+    # 残り100ユニットは予備なので、新しい検索は結果なし
+    assert cache.search("c") == ([], "degraded")
+    # 期限切れでも結果があれば古いものを返す
+    clock.now = 120
+    assert cache.search("a") == (results_for("a"), "stale")
+    stats = cache.stats()
+    assert (stats["degraded"], stats["stale"], stats["quota_remaining"]) == (1, 1, 100)
+
+
+def test_daily_reset_uses_injected_today():
+    today = [date(2026, 1, 1)]
+    cache = SearchCache(results_for, daily_quota=200, reserve_units=100, today=lambda: today[0])
+    assert cache.search("a")[1] == "miss"
+    assert cache.search("b")[1] == "degraded"
+    today[0] = date(2026, 1, 2)
+    assert cache.search("b")[1] == "miss"
+    assert cache.stats()["quota_used"] == 100
+
+
+def test_failed_fetch_without_cache_raises():
+    def fetch(query):
+        raise RuntimeError("YouTubeが落ちている")
+
+    cache = SearchCache(fetch)
+    with pytest.raises(RuntimeError):
+        cache.search("a")
+    assert cache.stats()["errors"] == 1
+
+
+def test_failed_fetch_falls_back_to_stale_for_leader_and_waiters():
+    clock = FakeClock()
+    cache = SearchCache(results_for, ttl_seconds=60, clock=clock)
+    cache.search("a")
+    clock.now = 120
+
+    fetch = BlockingFetch(error=RuntimeError("YouTubeが落ちている"))
+    cache._fetch = fetch
+    outcomes = concurrent_search(cache, fetch, ["a", "a", "a"])
+    assert outcomes == [(results_for("a"), "stale")] * 3
+    assert fetch.calls == 1
+    assert cache.stats()["stale"] == 3
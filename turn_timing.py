@@ -0,0 +1,61 @@
+# 1ターンごとの所要時間を測って記録する
+# 環境変数 AI_TURN_TIMING=1 のときは、1ターンごとにJSONを1行ずつ標準出力に出す（本番でも使える）
+# ベンチマークなどは add_listener() で記録をそのまま受け取れる
+# 描画時間などターン以外の出来事も、log() で同じスイッチのときだけ出す
+import json
+import os
+import threading
+import time
+
+ENABLED = os.environ.get("AI_TURN_TIMING") == "1"
+
+_listeners = []
+_listeners_lock = threading.Lock()
+
+
+def add_listener(listener):
+    with _listeners_lock:
+        _listeners.append(listener)
+
+
+def remove_listener(listener):
+    with _listeners_lock:
+        _listeners.remove(listener)
+
+
+def log(event, **values):
+    # AI_TURN_TIMING=1 のときだけ {"event": ..., <値>...} を1行のJSONで出す
+    if ENABLED:
+        print(json.dumps({"event": event, **values}, ensure_ascii=False))
+
+
+class TurnTimer:
+    """1ターン分の計測。mark() で区切りの時刻を、set() でその他の値を残し、finish() で記録する。
+
+    記録は {"session", "preset", "branch", "status", "total_ms", <区切り名>_ms..., <その他の値>...} の形。
+    """
+
+    def __init__(self, session_id, preset, branch):
+        self._start = time.perf_counter()
+        self.record = {"session": session_id, "preset": preset, "branch": branch}
+
+    def mark(self, name):
+        # 最初の1回だけ残す（「最初のチャンク」など）
+        self.record.setdefault(f"{name}_ms", self._elapsed_ms())
+
+    def set(self, **values):
+        self.record.update(values)
+
+    def finish(self, status):
+        self.record["status"] = status
+        self.record["total_ms"] = self._elapsed_ms()
+        if ENABLED:
+            print(json.dumps({"turn_timing": self.record}, ensure_ascii=False))
+        with _listeners_lock:
+            listeners = list(_listeners)
+        for listener in listeners:
+            listener(dict(self.record))
+        return self.record
+
+    def _elapsed_ms(self):
+        return round((time.perf_counter() - self._start) * 1000, 2)